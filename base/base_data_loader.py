@@ -1,7 +1,16 @@
+import collections
+import itertools
+import queue
+import random
+import threading
+import traceback
+
 import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import RandomSampler, Sampler, SequentialSampler, SubsetRandomSampler
 
 
 class BaseDataLoader(DataLoader):
@@ -9,7 +18,8 @@ class BaseDataLoader(DataLoader):
     Base class for all data loaders
     """
 
-    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate, test_config=None):
+    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate, test_config=None,
+                 persistent_workers=False, importance_sampling=None, read_ahead=0):
         self.validation_split = validation_split
         self.test_config = test_config
         self.shuffle = shuffle
@@ -24,6 +34,23 @@ class BaseDataLoader(DataLoader):
             self.sampler, self.test_sampler = self._split_test_sampler(
                 self.test_config['test_split'], self.sampler.indices)
 
+        # Draw the training samples in proportion to their recent loss, e.g. {"floor": 0.1, "momentum": 0.9}
+        self.importance_sampler = None
+        if importance_sampling is not None:
+            indices = self.sampler.indices if self.sampler is not None else np.arange(self.n_samples)
+            self.importance_sampler = LossHistorySampler(indices, len(dataset), **importance_sampling)
+            self.sampler = self.importance_sampler
+            self.shuffle = False
+
+        # Datasets with a prefetch method (e.g. OPUSDataset) read the files of the next read_ahead samples
+        # in the background. Only the main process keeps their contents, workers find them in the page cache.
+        self.read_ahead = read_ahead
+        self._read_ahead_batch_size = batch_size
+        self._read_ahead_keep_data = num_workers == 0
+        self.sampler = self._read_ahead_sampler(dataset, self.sampler, self.shuffle)
+        if self.sampler is not None:
+            self.shuffle = False
+
         self.init_kwargs = {
             'dataset': dataset,
             'batch_size': batch_size,
@@ -33,6 +60,36 @@ class BaseDataLoader(DataLoader):
         }
         super().__init__(sampler=self.sampler, **self.init_kwargs)
 
+        # One pool of long-lived workers serves this loader and the ones from split_validation/split_test
+        self.worker_pool = None
+        if persistent_workers:
+            self.worker_pool = WorkerPool(num_workers)
+            self.worker_pool.add_dataset('train', dataset, collate_fn)
+
+    def __iter__(self):
+        if self.worker_pool is not None:
+            return self.worker_pool.iterate('train', self.batch_sampler, self.pin_memory)
+        return super().__iter__()
+
+    def _phase_loader(self, phase, dataset, **kwargs):
+        """A DataLoader for another phase, served by the worker pool if there is one"""
+        if self.worker_pool is not None:
+            return PooledDataLoader(self.worker_pool, phase, dataset, **kwargs)
+        return DataLoader(dataset, **kwargs)
+
+    def _read_ahead_sampler(self, dataset, sampler=None, shuffle=False):
+        """
+        Enables the read-ahead of the dataset and wraps the sampler (a random or sequential
+        one if None) into a ReadAheadSampler. Returns the sampler unchanged without read_ahead.
+        """
+        if self.read_ahead <= 0 or not hasattr(dataset, 'prefetch'):
+            return sampler
+        # a sample is announced read_ahead indices ahead, the batch sampler draws a whole batch before loading it
+        dataset.enable_read_ahead(self.read_ahead + self._read_ahead_batch_size, keep_data=self._read_ahead_keep_data)
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        return ReadAheadSampler(sampler, dataset, self.read_ahead)
+
     def _split_val_sampler(self, split):
         if split == 0.0:
             return None, None
@@ -84,16 +141,411 @@ class BaseDataLoader(DataLoader):
 
         return train_sampler, test_sampler
 
+    def _full_frame_kwargs(self):
+        """Validation and test run on full frames, datasets with a patch mode provide full_frame()"""
+        init_kwargs = dict(self.init_kwargs)
+        if hasattr(init_kwargs['dataset'], 'full_frame'):
+            init_kwargs['dataset'] = init_kwargs['dataset'].full_frame()
+        return init_kwargs
+
     def split_validation(self):
         if self.valid_sampler is None:
             return None
         else:
-            return DataLoader(sampler=self.valid_sampler, **self.init_kwargs)
+            init_kwargs = self._full_frame_kwargs()
+            sampler = self._read_ahead_sampler(init_kwargs['dataset'], self.valid_sampler)
+            return self._phase_loader('val', sampler=sampler, **init_kwargs)
 
     def split_test(self):
         if self.test_sampler is None:
             return None
         else:
-            init_kwargs = self.init_kwargs
-            init_kwargs['batch_size'] = self.test_config['batch_size']
-            return DataLoader(sampler=self.test_sampler, **self.init_kwargs)
+            self.init_kwargs['batch_size'] = self.test_config['batch_size']
+            init_kwargs = self._full_frame_kwargs()
+            sampler = self._read_ahead_sampler(init_kwargs['dataset'], self.test_sampler)
+            return self._phase_loader('test', sampler=sampler, **init_kwargs)
+
+
+def _to_device(batch, device, non_blocking=False):
+    """Moves all tensors of a collated batch (tensor, tuple, list or dict) to the device"""
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(_to_device(b, device, non_blocking) for b in batch)
+    if isinstance(batch, dict):
+        return {k: _to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+def _pin_memory(batch):
+    """Pins all tensors of a collated batch (tensor, tuple, list or dict)"""
+    if torch.is_tensor(batch):
+        return batch.pin_memory()
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(_pin_memory(b) for b in batch)
+    if isinstance(batch, dict):
+        return {k: _pin_memory(v) for k, v in batch.items()}
+    return batch
+
+
+def _record_stream(batch, stream):
+    """Marks the tensors of a batch as used by the stream, so their memory is not reused too early"""
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (tuple, list)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+
+
+class _PrefetchError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END_OF_EPOCH = object()
+
+
+class DevicePrefetcher(object):
+    """
+    Wraps a data loader and moves the next batch to the device while the current one is used.
+
+    On CUDA devices the batches are pinned by the data loader and copied with
+    non-blocking transfers on a side stream. Otherwise a background thread
+    keeps up to buffer_size batches ready on the device.
+    All other attributes (batch_size, n_samples, split_validation, ...) are
+    those of the wrapped data loader.
+
+    data_loader: the data loader to wrap
+    device: the device the batches are moved to
+    buffer_size: number of batches the background thread keeps ready
+    """
+
+    def __init__(self, data_loader, device, buffer_size=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.buffer_size = buffer_size
+
+        self.use_cuda_stream = self.device.type == 'cuda' and torch.cuda.is_available()
+        if self.use_cuda_stream and isinstance(data_loader, DataLoader):
+            # the data loader pins the batches in its own thread
+            data_loader.pin_memory = True
+
+    def __getattr__(self, name):
+        # only called for attributes the prefetcher does not have itself
+        if name == 'data_loader':
+            raise AttributeError(name)
+        return getattr(self.data_loader, name)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.use_cuda_stream:
+            return self._iter_cuda_stream()
+        return self._iter_thread()
+
+    def _iter_cuda_stream(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.data_loader)
+
+        def stage():
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return _END_OF_EPOCH
+            with torch.cuda.stream(stream):
+                return _to_device(batch, self.device, non_blocking=True)
+
+        next_batch = stage()
+        while next_batch is not _END_OF_EPOCH:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+
+            next_batch = stage()
+            yield batch
+
+    def _iter_thread(self):
+        buffer = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up when the consumer stopped early, e.g. after len_epoch batches
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.data_loader:
+                    if not put(_to_device(batch, self.device)):
+                        return
+                put(_END_OF_EPOCH)
+            except Exception as e:
+                put(_PrefetchError(e))
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is _END_OF_EPOCH:
+                    return
+                if isinstance(item, _PrefetchError):
+                    raise item.exception
+                yield item
+        finally:
+            stop.set()
+
+
+def _pool_worker_loop(datasets, collate_fns, index_queue, result_queue, seed):
+    torch.set_num_threads(1)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2 ** 32)
+
+    while True:
+        task = index_queue.get()
+        if task is None:
+            break
+        iter_id, batch_idx, phase, indices = task
+        try:
+            batch = collate_fns[phase]([datasets[phase][i] for i in indices])
+            result_queue.put((iter_id, batch_idx, batch, None))
+        except Exception:
+            result_queue.put((iter_id, batch_idx, None, traceback.format_exc()))
+
+
+class WorkerPool(object):
+    """
+    Long-lived worker processes shared by the data loaders of all phases of a run.
+
+    The workers are forked once, on the first iteration, with all datasets
+    registered up to then and keep them (and their caches) for the whole run.
+    Iterating a phase sends batches of indices to the workers, switching from
+    train to val and back does not start new processes.
+
+    num_workers: number of worker processes, batches are loaded in the main process if 0
+    prefetch_factor: number of batches in flight per worker
+    """
+
+    _POLL_INTERVAL = 5.0
+
+    def __init__(self, num_workers, prefetch_factor=2):
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+
+        self._datasets = {}
+        self._collate_fns = {}
+        self._workers = []
+        self._index_queue = None
+        self._result_queue = None
+        self._started = False
+
+        self._iter_ids = itertools.count()
+        # results of the active iterations by iteration id and batch index
+        self._buffers = {}
+
+    def add_dataset(self, phase, dataset, collate_fn=default_collate):
+        self._datasets[phase] = dataset
+        self._collate_fns[phase] = collate_fn
+        if self._started:
+            # The running workers were forked without this dataset. Iterations still registered
+            # here were abandoned (e.g. stopped after len_epoch batches by inf_loop), their
+            # results are dropped with the old workers.
+            self._buffers.clear()
+            self.close()
+
+    def _start(self):
+        if self._started or self.num_workers == 0:
+            return
+
+        self._index_queue = multiprocessing.Queue()
+        self._result_queue = multiprocessing.Queue()
+        base_seed = torch.LongTensor(1).random_().item()
+        for worker_id in range(self.num_workers):
+            worker = multiprocessing.Process(
+                target=_pool_worker_loop,
+                args=(self._datasets, self._collate_fns, self._index_queue, self._result_queue,
+                      base_seed + worker_id))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._started = True
+
+    def close(self):
+        if not self._started:
+            return
+        for _ in self._workers:
+            self._index_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=self._POLL_INTERVAL)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        self._started = False
+
+    def _get(self, iter_id, batch_idx):
+        buffer = self._buffers.get(iter_id)
+        if buffer is None:
+            raise RuntimeError("The iteration was abandoned when datasets were added to the worker pool")
+        while batch_idx not in buffer:
+            try:
+                result_id, result_idx, batch, error = self._result_queue.get(timeout=self._POLL_INTERVAL)
+            except queue.Empty:
+                if any(not worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("A worker of the data loader pool exited unexpectedly")
+                continue
+            # results of abandoned iterations (e.g. stopped after len_epoch batches) are dropped
+            if result_id in self._buffers:
+                self._buffers[result_id][result_idx] = (batch, error)
+
+        batch, error = buffer.pop(batch_idx)
+        if error is not None:
+            raise RuntimeError("Error in a worker of the data loader pool:\n" + error)
+        return batch
+
+    def iterate(self, phase, batch_sampler, pin_memory=False):
+        """
+        Yields the batches of the phase dataset for the index batches of the batch sampler, in order.
+        With pin_memory, the batches are pinned in the consuming process, as the workers
+        cannot pin them for it.
+        """
+        batches = self._iterate(phase, batch_sampler)
+        if not pin_memory:
+            return batches
+        return (_pin_memory(batch) for batch in batches)
+
+    def _iterate(self, phase, batch_sampler):
+        if self.num_workers == 0:
+            dataset, collate_fn = self._datasets[phase], self._collate_fns[phase]
+            for indices in batch_sampler:
+                yield collate_fn([dataset[i] for i in indices])
+            return
+
+        self._start()
+        iter_id = next(self._iter_ids)
+        self._buffers[iter_id] = {}
+        index_batches = iter(batch_sampler)
+        n_sent = 0
+        try:
+            for indices in itertools.islice(index_batches, self.prefetch_factor * self.num_workers):
+                self._index_queue.put((iter_id, n_sent, phase, list(indices)))
+                n_sent += 1
+
+            for batch_idx in itertools.count():
+                if batch_idx == n_sent:
+                    return
+                batch = self._get(iter_id, batch_idx)
+                for indices in itertools.islice(index_batches, 1):
+                    self._index_queue.put((iter_id, n_sent, phase, list(indices)))
+                    n_sent += 1
+                yield batch
+        finally:
+            self._buffers.pop(iter_id, None)
+
+
+class PooledDataLoader(DataLoader):
+    """
+    A DataLoader whose batches are loaded by a WorkerPool, e.g. the validation
+    loader next to a BaseDataLoader with persistent_workers. Takes the usual
+    DataLoader arguments, num_workers is ignored.
+    """
+
+    def __init__(self, worker_pool, phase, dataset, **kwargs):
+        kwargs['num_workers'] = 0
+        super().__init__(dataset, **kwargs)
+        self.worker_pool = worker_pool
+        self.phase = phase
+        worker_pool.add_dataset(phase, dataset, self.collate_fn)
+
+    def __iter__(self):
+        return self.worker_pool.iterate(self.phase, self.batch_sampler, self.pin_memory)
+
+
+class LossHistorySampler(Sampler):
+    """
+    Draws the samples of an epoch with replacement, in proportion to their running loss.
+
+    The trainer reports the per-sample losses of every batch with update() (this needs
+    the dataset indices in the batch, e.g. with_idx for OPUS). Samples that have not been
+    seen yet count with the largest loss recorded so far, and every sample keeps at least
+    a floor share of the probability mass.
+
+    indices: dataset indices to draw from
+    dataset_size: number of samples of the dataset
+    floor: share of the probability that is spread uniformly over all samples
+    momentum: weight of the previous loss in the running loss of a sample
+    """
+
+    def __init__(self, indices, dataset_size, floor=0.1, momentum=0.9):
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        self.floor = floor
+        self.momentum = momentum
+        self.losses = torch.full((dataset_size,), float('nan'))
+
+    def update(self, indices, losses):
+        """
+        indices: dataset indices of the samples of a batch
+        losses: loss of every sample of the batch
+        """
+        indices = torch.as_tensor(indices).long().cpu()
+        losses = torch.as_tensor(losses).detach().float().cpu()
+
+        previous = self.losses[indices]
+        seen = ~torch.isnan(previous)
+        losses[seen] = self.momentum * previous[seen] + (1 - self.momentum) * losses[seen]
+        self.losses[indices] = losses
+
+    def probabilities(self):
+        losses = self.losses[self.indices].clone()
+        unseen = torch.isnan(losses)
+        losses[unseen] = losses[~unseen].max() if (~unseen).any() else 1.0
+        losses = losses.clamp(min=0)
+
+        uniform = torch.full_like(losses, 1.0 / len(losses))
+        if losses.sum() <= 0:
+            return uniform
+        return (1 - self.floor) * losses / losses.sum() + self.floor * uniform
+
+    def __iter__(self):
+        draws = torch.multinomial(self.probabilities(), len(self.indices), replacement=True)
+        return iter(self.indices[draws].tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ReadAheadSampler(Sampler):
+    """
+    Yields the indices of a sampler and announces each of them read_ahead indices
+    in advance with dataset.prefetch, so the dataset can fetch its files while
+    the samples before are loaded.
+    """
+
+    def __init__(self, sampler, dataset, read_ahead):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.read_ahead = read_ahead
+
+    def __iter__(self):
+        indices = iter(self.sampler)
+        upcoming = collections.deque(itertools.islice(indices, self.read_ahead))
+        self.dataset.prefetch(list(upcoming))
+
+        while upcoming:
+            for idx in itertools.islice(indices, 1):
+                upcoming.append(idx)
+                self.dataset.prefetch([idx])
+            yield upcoming.popleft()
+
+    def __len__(self):
+        return len(self.sampler)
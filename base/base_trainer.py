@@ -2,12 +2,19 @@ import torch
 from abc import abstractmethod
 from numpy import inf
 from logger import TensorboardWriter
+from base.base_data_loader import DevicePrefetcher
+from utils.mc_sampling import MCSampler
+
+# QuickNat's four pooling stages are undone by unpooling, so every stage has to halve the size exactly
+_RESOLUTION_DIVISOR = 16
 
 
 class BaseTrainer:
     """
     Base class for all trainers
     """
+    # trainers that use selective_backprop_threshold in their _train_epoch
+    supports_selective_backprop = False
 
     def __init__(self, model, criterion, metric_ftns, optimizer, config, experiment):
         self.config = config
@@ -29,6 +36,20 @@ class BaseTrainer:
         self.epochs = cfg_trainer['epochs']
         self.save_period = cfg_trainer['save_period']
         self.monitor = cfg_trainer.get('monitor', 'off')
+        # copy the next batch to the device while the current one is processed
+        self.prefetch = cfg_trainer.get('prefetch', False)
+        # progressive resolution: [[first epoch, input size], ...], e.g. [[1, 208], [6, 304], [11, 400]]
+        self.resolution_schedule = sorted(cfg_trainer.get('resolution_schedule', []))
+        for _, input_size in self.resolution_schedule:
+            if input_size % _RESOLUTION_DIVISOR != 0:
+                raise ValueError("Input size {} of the resolution schedule is not a multiple of {}".format(
+                    input_size, _RESOLUTION_DIVISOR))
+        self.input_size = None
+        # skip the backward pass for samples whose loss is below the threshold (needs dataset indices in the batches)
+        self.selective_backprop_threshold = cfg_trainer.get('selective_backprop_threshold')
+        # MC-dropout samples folded into the batch, in passes of at most mc_max_batch_size images
+        # or sized to mc_memory_budget_mb of CUDA memory
+        self.mc_sampler = MCSampler.from_config(cfg_trainer)
 
         # configuration to monitor model performance and save best
         if self.monitor == 'off':
@@ -70,8 +91,10 @@ class BaseTrainer:
         """
         Full training logic
         """
+        self._check_selective_backprop()
         not_improved_count = 0
         for epoch in range(self.start_epoch, self.epochs + 1):
+            self._apply_resolution_schedule(epoch)
             result = self._train_epoch(epoch)
 
             # save logged informations into log dict
@@ -132,6 +155,81 @@ class BaseTrainer:
         log.update(**{'best_'+k: v for k, v in log.items()})
         self.experiment.log_metrics(**log)
 
+    def _apply_resolution_schedule(self, epoch):
+        """
+        Sets the resolution of the training data for the epoch according to the resolution schedule
+        """
+        input_size = None
+        for first_epoch, size in self.resolution_schedule:
+            if epoch >= first_epoch:
+                input_size = size
+        if input_size is None or input_size == self.input_size:
+            return
+
+        set_input_size = getattr(self.data_loader, 'set_input_size', None)
+        if set_input_size is None:
+            self.logger.warning("Warning: The data loader does not support a resolution schedule "
+                                "(it needs set_input_size and epoch-based training), it is ignored.")
+            self.resolution_schedule = []
+            return
+
+        self.logger.info('Training resolution: {}'.format(input_size))
+        set_input_size(input_size)
+        self.input_size = input_size
+
+    def _importance_sampler(self):
+        """
+        The LossHistorySampler of the training data loader, None if it does not use one
+        """
+        return getattr(self.data_loader, 'importance_sampler', None)
+
+    def _check_selective_backprop(self):
+        """
+        Warns if selective_backprop_threshold is set but has no effect, i.e. the trainer does
+        not implement selective backprop or the training data loader has no importance sampler
+        """
+        if self.selective_backprop_threshold is None:
+            return
+        if not self.supports_selective_backprop:
+            self.logger.warning("Warning: selective_backprop_threshold is set, but {} does not support "
+                                "selective backprop. Training uses the full backward pass.".format(
+                                    type(self).__name__))
+        elif self._importance_sampler() is None:
+            self.logger.warning("Warning: selective_backprop_threshold is set, but the training data loader "
+                                "has no importance sampler (set importance_sampling in the data loader and "
+                                "train epoch-based, without len_epoch). Training uses the full backward pass.")
+
+    def _select_samples(self, sample_losses):
+        """
+        Selective backprop: mask of the samples whose loss reaches the threshold,
+        at least the hardest sample of the batch is kept
+        """
+        keep = sample_losses >= self.selective_backprop_threshold
+        if not keep.any():
+            keep[sample_losses.argmax()] = True
+        return keep.to(self.device)
+
+    def _score_batch(self, data):
+        """
+        Selective backprop: model output for scoring the samples of a batch, from one
+        deterministic pass without gradients. The model is in eval mode meanwhile, so
+        batch norm keeps its running statistics and dropout leaves the training pass alone.
+        """
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                return self.model(data)
+        finally:
+            self.model.train()
+
+    def _prefetch(self, data_loader):
+        """
+        Wraps the data loader into a DevicePrefetcher if 'prefetch' is set in the trainer config
+        """
+        if not self.prefetch or data_loader is None:
+            return data_loader
+        return DevicePrefetcher(data_loader, self.device)
+
     def _prepare_device(self, n_gpu_use):
         """
         setup GPU device if available, move model into configured device
@@ -1,3 +1,11 @@
 from .mnist_dataloader import *
+from .lidc_store import *
 from .lidc_dataloader import *
-from .opus_dataloader import *
\ No newline at end of file
+from .opus_manifest import *
+from .label_mask import *
+from .opus_store import *
+from .transform_cache import *
+from .augmentation_bank import *
+from .batch_transforms import *
+from .opus_dataloader import *
+from .opus_shards import *
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from data_loaders.label_mask import pack_mask, unpack_mask
+from utils import ensure_dir, read_json, write_json
+
+# =============================================================================
+# Offline augmentation bank
+# K augmented variants of every training sample, generated once by DataLoader
+# workers and stored on disk. Each epoch serves one random variant per sample,
+# so the CPU cost of the augmentation is paid once instead of every epoch.
+# variant_xxx_images.npy: float32 images of variant xxx, shape [N x C x H x W]
+# variant_xxx_labels.npy: bit-packed label masks of variant xxx, shape [N x ceil(H * W / 8)]
+# index.json:             bank key, label shape and generation counter of every variant
+# =============================================================================
+
+_INDEX_FILENAME = 'index.json'
+_IMAGES_FILENAME = 'variant_{:03d}_images.npy'
+_LABELS_FILENAME = 'variant_{:03d}_labels.npy'
+# part of the bank key, banks written in another format are regenerated
+_FORMAT = 'packed_labels'
+
+
+def _unbatch(batch):
+    return batch[0]
+
+
+class _AugmentedSamples(Dataset):
+    """Runs the transform of a dataset on its raw samples, independent of how the dataset serves them"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset.transform(self.dataset._load_sample(idx))
+        image = np.asarray(sample['image'], dtype=np.float32)
+        labels = np.asarray(sample['labels']).squeeze().astype(np.uint8)
+        return idx, image, labels
+
+
+class AugmentationBank(object):
+    """
+    On-disk bank of augmented variants of the samples of an OPUSDataset.
+
+    bank_dir: folder the variants are written to
+    n_variants: number of augmented variants per sample
+    """
+
+    def __init__(self, bank_dir, n_variants):
+        self.bank_dir = bank_dir
+        self.n_variants = n_variants
+        ensure_dir(bank_dir)
+
+        self.key = None
+        self.label_shape = None
+        # generation of every variant, 0 while a variant has not been written
+        self.generations = [0] * n_variants
+        self.next_refresh = 0
+
+        self._index_path = os.path.join(bank_dir, _INDEX_FILENAME)
+        self._index_mtime = None
+        if os.path.isfile(self._index_path):
+            index = read_json(self._index_path)
+            if index['n_variants'] == n_variants:
+                self.key = index['key']
+                self.label_shape = index.get('label_shape')
+                self.generations = index['generations']
+                self.next_refresh = index['next_refresh']
+                self._index_mtime = os.stat(self._index_path).st_mtime_ns
+
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        state['_lock'] = None
+        state['_refresh_thread'] = None
+        return state
+
+    @staticmethod
+    def dataset_key(dataset):
+        """The bank is only valid for the same samples in the same order and the same transform"""
+        content = _FORMAT + '\n' + repr(dataset.transform) + '\n' + '\n'.join(dataset.image_list)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _save_index(self):
+        index_path = self._index_path
+        tmp_path = index_path + '.tmp{}'.format(os.getpid())
+        write_json({'key': self.key,
+                    'n_variants': self.n_variants,
+                    'label_shape': self.label_shape,
+                    'generations': self.generations,
+                    'next_refresh': self.next_refresh},
+                   tmp_path)
+        os.replace(tmp_path, index_path)
+
+    def _generate(self, dataset, variant, num_workers):
+        """Writes one variant of all samples, the previous files stay readable until they are replaced"""
+        loader = DataLoader(_AugmentedSamples(dataset), batch_size=1, num_workers=num_workers,
+                            collate_fn=_unbatch)
+
+        images_path = os.path.join(self.bank_dir, _IMAGES_FILENAME.format(variant))
+        labels_path = os.path.join(self.bank_dir, _LABELS_FILENAME.format(variant))
+        tmp_suffix = '.tmp{}'.format(os.getpid())
+        images, labels = None, None
+
+        for idx, image, label in loader:
+            packed_label = pack_mask(label)
+            if images is None:
+                images = np.lib.format.open_memmap(images_path + tmp_suffix, mode='w+', dtype=np.float32,
+                                                   shape=(len(dataset),) + image.shape)
+                labels = np.lib.format.open_memmap(labels_path + tmp_suffix, mode='w+', dtype=np.uint8,
+                                                   shape=(len(dataset),) + packed_label.shape)
+                label_shape = list(label.shape)
+            images[idx] = image
+            labels[idx] = packed_label
+
+        images.flush()
+        labels.flush()
+        del images, labels
+        os.replace(images_path + tmp_suffix, images_path)
+        os.replace(labels_path + tmp_suffix, labels_path)
+
+        with self._lock:
+            self.label_shape = label_shape
+            self.generations[variant] = max(self.generations) + 1
+            self._save_index()
+
+    def build(self, dataset, num_workers=0):
+        """Generates every variant that is missing or was generated for other samples or another transform"""
+        key = self.dataset_key(dataset)
+        if key != self.key:
+            self.key = key
+            self.generations = [0] * self.n_variants
+            self.next_refresh = 0
+
+        for variant in range(self.n_variants):
+            if self.generations[variant] == 0:
+                print("Generating augmentation bank variant {}/{}".format(variant + 1, self.n_variants))
+                self._generate(dataset, variant, num_workers)
+
+    def refresh_async(self, dataset, n_variants, num_workers=0):
+        """
+        Regenerates the n_variants oldest variants in a background thread, the
+        augmentation itself runs in DataLoader workers. Variants that are
+        replaced are served from the new files by the next epoch's workers.
+        Does nothing while a previous refresh is still running.
+        """
+        if n_variants <= 0 or (self._refresh_thread is not None and self._refresh_thread.is_alive()):
+            return
+
+        variants = [(self.next_refresh + i) % self.n_variants for i in range(min(n_variants, self.n_variants))]
+        self.next_refresh = (self.next_refresh + len(variants)) % self.n_variants
+
+        def refresh():
+            for variant in variants:
+                self._generate(dataset, variant, num_workers)
+
+        self._refresh_thread = threading.Thread(target=refresh, daemon=True)
+        self._refresh_thread.start()
+
+    def wait(self):
+        """Waits for a running refresh to finish"""
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+
+    def _sync_generations(self):
+        """Persistent workers (see base.WorkerPool) learn about refreshed variants from the index file"""
+        mtime = os.stat(self._index_path).st_mtime_ns
+        if mtime != self._index_mtime:
+            index = read_json(self._index_path)
+            self.generations = index['generations']
+            self.label_shape = index['label_shape']
+            self._index_mtime = mtime
+
+    def _variant(self, variant):
+        # reopen the files if the variant was regenerated since they were mapped
+        generation = self.generations[variant]
+        if variant not in self._maps or self._maps[variant][0] != generation:
+            images = np.load(os.path.join(self.bank_dir, _IMAGES_FILENAME.format(variant)), mmap_mode='r')
+            labels = np.load(os.path.join(self.bank_dir, _LABELS_FILENAME.format(variant)), mmap_mode='r')
+            self._maps[variant] = (generation, images, labels)
+        return self._maps[variant][1:]
+
+    def sample(self, idx):
+        """Returns one random variant of the sample as a transformed sample dict"""
+        self._sync_generations()
+        images, labels = self._variant(random.randrange(self.n_variants))
+        return {'image': torch.from_numpy(np.array(images[idx])),
+                'labels': torch.from_numpy(unpack_mask(labels[idx], self.label_shape))}
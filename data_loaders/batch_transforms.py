@@ -0,0 +1,112 @@
+import inspect
+
+import torch
+import torch.nn.functional as F
+
+# =============================================================================
+# Batch transforms
+# Augmentations applied after collate on whole batches of tensors, on the
+# device the batch lives on (the trainer applies them after data.to(device)).
+# images: [BATCH_SIZE x C x H x W], labels: [BATCH_SIZE x H x W]
+# =============================================================================
+
+# grid_sample aligns the corners before torch 1.3 and needs to be told so afterwards
+_GRID_SAMPLE_KWARGS = {'align_corners': True} if 'align_corners' in inspect.signature(F.grid_sample).parameters else {}
+
+# elastic_deform draws the deformation point and displacement for a 400 x 400 frame
+_REFERENCE_SIZE = 400
+
+
+def _smooth_ramp(t):
+    """Cubic ramp going from 0 at t <= 0 to 1 at t >= 1 with zero slope at both ends"""
+    t = t.clamp(0, 1)
+    return t * t * (3 - 2 * t)
+
+
+def _displacement_profile(centers, size):
+    """
+    Separable part of the displacement field along one axis.
+
+    centers: [BATCH_SIZE] position of the deformation point along the axis
+    returns: [BATCH_SIZE x size], 1 at the deformation point and 0 at both borders,
+             where elastic_deformation keeps its anchor points fixed
+    """
+    pos = torch.arange(size, dtype=torch.float32, device=centers.device).unsqueeze(0)
+    centers = centers.unsqueeze(1)
+    rising = _smooth_ramp(pos / centers)
+    falling = _smooth_ramp((size - 1 - pos) / (size - 1 - centers))
+    return torch.where(pos <= centers, rising, falling)
+
+
+def _warp(tensor, grid, mode):
+    """Samples a [B x H x W] or [B x C x H x W] tensor at the grid positions"""
+    squeeze = tensor.dim() == 3
+    out = tensor.unsqueeze(1) if squeeze else tensor
+    out = F.grid_sample(out.float(), grid, mode=mode, padding_mode='border', **_GRID_SAMPLE_KWARGS)
+    out = out.squeeze(1) if squeeze else out
+    return out.to(tensor.dtype)
+
+
+class BatchElasticDeform(object):
+    """
+    Batched counterpart of elastic_deform. Every sample gets one deformation
+    point with a random displacement that decays smoothly to zero at the image
+    border. Images are warped bilinearly and labels with nearest neighbour
+    sampling, all in a single grid_sample call each.
+    """
+
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, images, labels):
+        batch_size, _, h, w = images.shape
+        device = images.device
+
+        apply = (torch.rand(batch_size, device=device) < self.p).float()
+        if apply.sum() == 0:
+            return images, labels
+
+        scale_h, scale_w = h / _REFERENCE_SIZE, w / _REFERENCE_SIZE
+        y_coo = torch.randint(100, 300, (batch_size,), device=device).float() * scale_h
+        x_coo = torch.randint(100, 300, (batch_size,), device=device).float() * scale_w
+        dy = torch.randint(10, 40, (batch_size,), device=device).float() * scale_h * apply
+        dx = torch.randint(10, 40, (batch_size,), device=device).float() * scale_w * apply
+
+        # [B x H x W] displacement weight, 1 at the deformation point
+        weight = _displacement_profile(y_coo, h).unsqueeze(2) * _displacement_profile(x_coo, w).unsqueeze(1)
+
+        base_y = torch.arange(h, dtype=torch.float32, device=device).view(1, h, 1)
+        base_x = torch.arange(w, dtype=torch.float32, device=device).view(1, 1, w)
+        pos_y = base_y + dy.view(-1, 1, 1) * weight
+        pos_x = base_x + dx.view(-1, 1, 1) * weight
+
+        # grid_sample expects (x, y) positions normalized to [-1, 1]
+        grid = torch.stack((2 * pos_x / (w - 1) - 1, 2 * pos_y / (h - 1) - 1), dim=-1)
+
+        return _warp(images, grid, 'bilinear'), _warp(labels, grid, 'nearest')
+
+
+class BatchRandomHorizontalFlip(object):
+    """Batched counterpart of RandomHorizontalFlip, flips every sample with probability p"""
+
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, images, labels):
+        flip = torch.rand(images.shape[0], device=images.device) < self.p
+
+        images = torch.where(flip.view(-1, *([1] * (images.dim() - 1))), images.flip(-1), images)
+        labels = torch.where(flip.view(-1, *([1] * (labels.dim() - 1))), labels.flip(-1), labels)
+        return images, labels
+
+
+class BatchCompose(object):
+    """Composes several batch transforms together"""
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, images, labels):
+        for t in self.transforms:
+            images, labels = t(images, labels)
+        return images, labels
@@ -0,0 +1,46 @@
+import numpy as np
+
+# =============================================================================
+# Compact label masks
+# Binary ROI labels are kept as uint8 {0, 1} masks from loading to the tensor
+# and bit-packed (8 pixels per byte) on disk. The label transforms sample
+# nearest neighbours, so the masks never leave integer space and need no
+# re-thresholding.
+# =============================================================================
+
+
+def label_mask(labels):
+    """uint8 {0, 1} mask of the foreground (label > 0.5, e.g. ROI files with 0/255 values)"""
+    labels = np.asarray(labels)
+    if labels.dtype == np.uint8 and labels.size and labels.max() <= 1:
+        return labels
+    return (labels > 0.5).astype(np.uint8)
+
+
+def pack_mask(mask):
+    """Bit-packs a {0, 1} mask of any shape into a flat uint8 array"""
+    return np.packbits(np.asarray(mask, dtype=np.uint8).ravel())
+
+
+def unpack_mask(packed, shape):
+    """Inverse of pack_mask"""
+    size = int(np.prod(shape))
+    # no count argument, it needs numpy >= 1.17
+    return np.unpackbits(packed)[:size].reshape(shape)
+
+
+def packed_size(shape):
+    """Number of bytes pack_mask needs for a mask of this shape"""
+    return (int(np.prod(shape)) + 7) // 8
+
+
+def resize_mask(mask, output_shape):
+    """
+    Nearest neighbour resize of the first two axes of a mask, trailing axes are kept.
+    A pure index gather, so the dtype of the mask is preserved.
+    """
+    h, w = mask.shape[:2]
+    new_h, new_w = output_shape
+    rows = np.minimum(((np.arange(new_h) + 0.5) * (h / new_h)).astype(np.intp), h - 1)
+    cols = np.minimum(((np.arange(new_w) + 0.5) * (w / new_w)).astype(np.intp), w - 1)
+    return mask[rows[:, None], cols[None, :]]
@@ -11,7 +11,8 @@ import pickle
 from torch.utils.data import Dataset
 from torchvision import transforms
 import torch
-from utils import load_pickle_file
+from utils import SharedArrayTable, StagingCache, load_pickle_file
+from data_loaders.lidc_store import LIDCShardStore, is_lidc_store
 import _pickle as cPickle
 import gc
 
@@ -21,10 +22,12 @@ class LidcDataLoader(BaseDataLoader):
     LIDC data loader
     """
 
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_workers=1, test_config=None, use_percentage=None):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_workers=1, test_config=None, use_percentage=None,
+                 shared_memory=False, dtype='float32', staging_dir=None, staging_budget_gb=None):
 
         self.data_dir = data_dir
-        self.dataset = LIDC_IDRI(self.data_dir, use_percentage=use_percentage)
+        self.dataset = LIDC_IDRI(self.data_dir, use_percentage=use_percentage, shared_memory=shared_memory,
+                                 dtype=dtype, staging_dir=staging_dir, staging_budget_gb=staging_budget_gb)
         super().__init__(self.dataset, batch_size, shuffle, validation_split, num_workers, test_config=test_config)
 
     def set_random_sampling_mode(self):
@@ -39,14 +42,27 @@ class LIDC_IDRI(Dataset):
     labels = []
     sampling_mode = None
 
-    def __init__(self, dataset_location, transform=None, use_percentage=None):
+    def __init__(self, dataset_location, transform=None, use_percentage=None, shared_memory=False, dtype='float32',
+                 staging_dir=None, staging_budget_gb=None):
         self.transform = transform
+        self.store = None
+        # dtype the images are kept in, converted once while loading
+        self.dtype = np.dtype(dtype)
+
+        # A folder written by data_loaders.lidc_store is opened lazily instead of unpickling everything
+        if is_lidc_store(dataset_location):
+            self._open_store(dataset_location, use_percentage)
+            return
+
         data = {}
         for file in os.listdir(dataset_location):
             filename = os.fsdecode(file)
             if '.pickle' in filename:
                 print("Loading file", filename)
                 file_path = dataset_location + filename
+                if staging_dir is not None:
+                    # a local copy of the pickle, e.g. for repeated runs on the same node
+                    file_path = StagingCache(dataset_location, staging_dir, staging_budget_gb).stage(file_path)
 
                 with open(file_path, 'rb') as f_in:
                     # disable garbage collector
@@ -68,7 +84,7 @@ class LIDC_IDRI(Dataset):
         for key, value in data.items():
             if i >= n:
                 break
-            self.images[i] = value['image'].astype(float)
+            self.images[i] = value['image'].astype(self.dtype)
             self.labels[i] = value['masks']
             i += 1
 
@@ -81,17 +97,46 @@ class LIDC_IDRI(Dataset):
 
         del data
 
+        if shared_memory:
+            # one shared segment per table instead of per-sample arrays in Python lists,
+            # so DataLoader workers do not copy the whole dataset
+            self.images = SharedArrayTable(self.images)
+            self.labels = SharedArrayTable([np.asarray(label) for label in self.labels])
+
+    def _open_store(self, store_dir, use_percentage):
+        self.store = LIDCShardStore(store_dir)
+
+        n = len(self.store)
+        if use_percentage is not None:
+            assert 0 < use_percentage <= 1
+            n = int(use_percentage * n)
+        self.n_samples = n
+
+        print("Using LIDC-IDRI dataset with size: ", n)
+
+        # value ranges are precomputed per shard by the converter
+        image_min, image_max, mask_min, mask_max = self.store.value_range(n)
+        assert image_max <= 1 and image_min >= 0
+        assert mask_max <= 1 and mask_min >= 0
+
     def __getitem__(self, index):
-        image = np.expand_dims(self.images[index], axis=0)
-        image = torch.from_numpy(image).float()
+        if self.store is not None:
+            image, labels = self.store[index]
+            image = torch.from_numpy(np.expand_dims(image, axis=0).astype(self.dtype)).float()
+        else:
+            image = np.expand_dims(self.images[index], axis=0)
+            image = torch.from_numpy(image).float()
+            labels = self.labels[index]
 
         if self.transform is not None:
             image = self.transform(image)
 
-        labels = torch.tensor(self.labels[index]).float()
+        labels = torch.tensor(labels).float()
 
         return image, labels
 
     # Override to give PyTorch size of dataset
     def __len__(self):
+        if self.store is not None:
+            return self.n_samples
         return len(self.images)
@@ -0,0 +1,132 @@
+import bisect
+import os
+
+import numpy as np
+
+from utils import ensure_dir, load_pickle_file, read_json, write_json
+
+# =============================================================================
+# Sharded, memory-mapped LIDC-IDRI format
+# images_xxx.npy: float32 images of a shard, shape [N x H x W]
+# masks_xxx.npy:  uint8 annotator masks of a shard, shape [N x 4 x H x W],
+#                 bit-packed along the last axis if 'packed_masks' is set
+# index.json:     shard sizes, image shape and value range statistics
+# =============================================================================
+
+_INDEX_FILENAME = 'index.json'
+_IMAGES_FILENAME = 'images_{:03d}.npy'
+_MASKS_FILENAME = 'masks_{:03d}.npy'
+
+
+def is_lidc_store(dataset_location):
+    return os.path.isfile(os.path.join(dataset_location, _INDEX_FILENAME))
+
+
+def convert_lidc_dataset(pickle_path, store_dir, shard_size=1024, pack_masks=True):
+    """
+    Converts the LIDC-IDRI pickle into the sharded store once.
+
+    pickle_path: path to the LIDC pickle file
+    store_dir: folder the store is written to
+    shard_size: number of samples per shard
+    pack_masks: store the binary masks with 8 pixels per byte
+    """
+    ensure_dir(store_dir)
+    data = load_pickle_file(pickle_path)
+
+    shards = []
+    items = list(data.values())
+    for shard_idx, start in enumerate(range(0, len(items), shard_size)):
+        shard_items = items[start:start + shard_size]
+        images = np.stack([item['image'] for item in shard_items]).astype(np.float32)
+        masks = np.stack([np.stack(item['masks']) for item in shard_items])
+
+        if not np.array_equal(masks, masks.astype(bool)):
+            raise ValueError("LIDC masks of shard {} are not binary".format(shard_idx))
+        masks = masks.astype(np.uint8)
+
+        shards.append({'size': len(shard_items),
+                       'image_min': float(images.min()),
+                       'image_max': float(images.max()),
+                       'mask_min': int(masks.min()),
+                       'mask_max': int(masks.max())})
+
+        if pack_masks:
+            masks = np.packbits(masks, axis=-1)
+
+        np.save(os.path.join(store_dir, _IMAGES_FILENAME.format(shard_idx)), images)
+        np.save(os.path.join(store_dir, _MASKS_FILENAME.format(shard_idx)), masks)
+        del images, masks
+
+    image_shape = list(np.shape(items[0]['image'])) if items else []
+    del items, data
+
+    # The index is written last, so an interrupted conversion never leaves a usable store behind
+    write_json({'image_shape': image_shape,
+                'packed_masks': pack_masks,
+                'shards': shards},
+               os.path.join(store_dir, _INDEX_FILENAME))
+
+
+class LIDCShardStore(object):
+    """
+    Lazy read access to a store written by convert_lidc_dataset. Only the
+    index is read on construction, the shards are memory-mapped on first use.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        index = read_json(os.path.join(store_dir, _INDEX_FILENAME))
+        self.image_shape = index['image_shape']
+        self.packed_masks = index['packed_masks']
+        self.shards = index['shards']
+
+        # global index of the first sample of every shard
+        self._shard_starts = []
+        n = 0
+        for shard in self.shards:
+            self._shard_starts.append(n)
+            n += shard['size']
+        self._len = n
+
+        self._images = [None] * len(self.shards)
+        self._masks = [None] * len(self.shards)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = [None] * len(self.shards)
+        state['_masks'] = [None] * len(self.shards)
+        return state
+
+    def value_range(self, n=None):
+        """Returns (image min, image max, mask min, mask max) over the shards holding the first n samples"""
+        n = self._len if n is None else n
+        shards = [shard for shard, start in zip(self.shards, self._shard_starts) if start < n]
+        if not shards:
+            return 0, 0, 0, 0
+        return (min(s['image_min'] for s in shards), max(s['image_max'] for s in shards),
+                min(s['mask_min'] for s in shards), max(s['mask_max'] for s in shards))
+
+    def _shard(self, shard_idx):
+        if self._images[shard_idx] is None:
+            self._images[shard_idx] = np.load(
+                os.path.join(self.store_dir, _IMAGES_FILENAME.format(shard_idx)), mmap_mode='r')
+            self._masks[shard_idx] = np.load(
+                os.path.join(self.store_dir, _MASKS_FILENAME.format(shard_idx)), mmap_mode='r')
+        return self._images[shard_idx], self._masks[shard_idx]
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        shard_idx = bisect.bisect_right(self._shard_starts, index) - 1
+        images, masks = self._shard(shard_idx)
+        local_idx = index - self._shard_starts[shard_idx]
+
+        image = images[local_idx]
+        mask = masks[local_idx]
+        if self.packed_masks:
+            mask = np.unpackbits(mask, axis=-1)[..., :self.image_shape[-1]]
+
+        return image, mask
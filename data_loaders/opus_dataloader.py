@@ -1,16 +1,24 @@
+import copy
 import os
 import random
-import re
 import math
 
 import numpy as np
 import torch
 from skimage import transform
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from torchvision import transforms
 
 from base import BaseDataLoader
-from utils import elastic_deformation, load_files, norm
+from data_loaders.augmentation_bank import AugmentationBank
+from data_loaders.batch_transforms import BatchCompose, BatchElasticDeform, BatchRandomHorizontalFlip
+from data_loaders.label_mask import label_mask, resize_mask
+from data_loaders.opus_manifest import OPUSManifest
+from data_loaders.opus_store import OPUSSampleStore, write_opus_store
+from data_loaders.patch_sampler import ForegroundPatchSampler, foreground_box
+from data_loaders.read_ahead import FileReadAhead
+from data_loaders.transform_cache import CachedTransform
+from utils import SharedStringTable, StagingCache, apply_displacement, elastic_displacement, load_files, norm
 
 #data_path = '/data/OPUS_nerve_segmentation/OPUS_data_1'
 #data_path = '/data/OPUS_nerve_segmentation/OPUS_data_2'
@@ -20,6 +28,10 @@ _NUM_CLASSES = 3
 _CLASS_MEDIANUS = 'medianus'
 _CLASS_ULNARIS = 'ulnaris'
 _CLASS_RADIALIS = 'radialis'
+_NERVE_CLASSES = [_CLASS_MEDIANUS, _CLASS_ULNARIS, _CLASS_RADIALIS]
+
+# dtype the samples are converted to right after loading, all transforms keep it
+DEFAULT_DTYPE = 'float32'
 
 
 def class_str_to_index(class_str):
@@ -35,6 +47,40 @@ def class_str_to_index(class_str):
     return out
 
 
+def list_opus_samples(data_path, patients_list=None, manifest_path=None):
+    """
+    Paired samples of the OPUS patient folders as dicts with the keys 'patient',
+    'nerve_class', 'class_index', 'image_path' and 'label_path'.
+
+    data_path: root folder of the OPUS data containing the patient_xxx folders
+    patients_list: patients to list, all patient folders by default
+    manifest_path: dataset manifest to pair the files with (see data_loaders.opus_manifest)
+    """
+    if patients_list is None:
+        patients_list = sorted(p for p in os.listdir(data_path) if p.startswith('patient_'))
+
+    manifest = OPUSManifest(data_path, _NERVE_CLASSES, manifest_path)
+    samples = []
+    for patient in patients_list:
+        for sample in manifest.patient_samples(patient):
+            samples.append({'patient': patient,
+                            'nerve_class': sample['nerve_class'],
+                            'class_index': class_str_to_index(sample['nerve_class']),
+                            'image_path': sample['image_path'],
+                            'label_path': sample['label_path']})
+    manifest.save()
+    return samples
+
+
+def convert_opus_dataset(data_path, store_dir, patients_list=None, manifest_path=None):
+    """
+    One-time conversion of the OPUS patient folders into a memory-mapped
+    sample store (see data_loaders.opus_store), which OPUSDataset can serve
+    from with store_dir. The arguments are those of list_opus_samples.
+    """
+    write_opus_store(list_opus_samples(data_path, patients_list, manifest_path), store_dir)
+
+
 # =============================================================================
 # dataloader, augmentation, batch
 # class for custom dataset
@@ -45,16 +91,32 @@ def class_str_to_index(class_str):
 
 class OPUSDataset(Dataset):
 
-    def __init__(self, phase, data_path, transform=None, with_idx=False, cross_val=None):
+    def __init__(self, phase, data_path, transform=None, with_idx=False, cross_val=None, store_dir=None,
+                 manifest_path=None, cache_transforms=False, transform_cache_dir=None, shared_memory=False,
+                 patch_size=None, foreground_fraction=0.5, dtype=DEFAULT_DTYPE, staging_dir=None,
+                 staging_budget_gb=None):
 
         self.transform = transform
         self.phase = phase
+        self.dtype = np.dtype(dtype)
 
         self.image_list = list()
         self.us_list = list()
         self.labels_list = list()
         self.classes_list = list()
+        self.store_idx_list = list()
         self.with_idx = with_idx
+        # Background reads of the files of the upcoming samples, see enable_read_ahead
+        self.read_ahead = None
+
+        # Serve the samples from a preprocessed memory-mapped store instead of the .mat files
+        self.store = OPUSSampleStore(store_dir) if store_dir is not None else None
+        # Local copies of the .mat files, e.g. of a data_path on network storage
+        self.staging = None
+        if staging_dir is not None and self.store is None:
+            self.staging = StagingCache(data_path, staging_dir, staging_budget_gb)
+        # Paired file lists of the patients, persisted to manifest_path if given
+        self.manifest = OPUSManifest(data_path, _NERVE_CLASSES, manifest_path) if self.store is None else None
         self.patients_list = ['patient_001', 'patient_002', 'patient_003', 'patient_004', 'patient_005',
                               'patient_006', 'patient_007', 'patient_008', 'patient_009', 'patient_010', 'patient_011']
 
@@ -74,15 +136,40 @@ class OPUSDataset(Dataset):
 
         # Load patient data
         for x in self.patients_list:
-            data_path_patient = os.path.join(data_path, x)
-            self._load_patient(data_path_patient)
+            if self.store is not None:
+                self._load_patient_from_store(x)
+            else:
+                self._load_patient(x)
+        if self.manifest is not None:
+            self.manifest.save()
 
         # Sort all lists by image_list
-        sorted_data = sorted(
-            zip(self.image_list, self.labels_list, self.classes_list))
-        self.image_list = [a for a, _, _ in sorted_data]
-        self.labels_list = [b for _, b, _ in sorted_data]
-        self.classes_list = [c for _, _, c in sorted_data]
+        order = sorted(range(len(self.image_list)),
+                       key=lambda i: (self.image_list[i], self.labels_list[i], self.classes_list[i]))
+        self.image_list = [self.image_list[i] for i in order]
+        self.labels_list = [self.labels_list[i] for i in order]
+        self.classes_list = [self.classes_list[i] for i in order]
+        if self.store is not None:
+            self.store_idx_list = [self.store_idx_list[i] for i in order]
+
+        # Patch mode: random crops of the transformed samples, a foreground_fraction of them over the nerve
+        self.patch_sampler = None
+        self.foreground_boxes = None
+        if patch_size is not None:
+            self.patch_sampler = ForegroundPatchSampler(patch_size, foreground_fraction)
+            self.foreground_boxes = self._foreground_boxes()
+
+        if shared_memory:
+            self._share_memory()
+
+        # Cache the output of the deterministic transforms (e.g. Rescale and ToTensor for val/test)
+        self.transform_cache = None
+        self.transform_cache_dir = transform_cache_dir
+        if cache_transforms and transform is not None:
+            self._build_transform_cache()
+
+        # Pre-generated augmented variants of the samples (see data_loaders.augmentation_bank)
+        self.augmentation_bank = None
 
     def use_cross_validation(self, cross_val, phase):
 
@@ -125,73 +212,175 @@ class OPUSDataset(Dataset):
             # patients for validation
             self.patients_list = ['patient_011']
 
-    def _load_patient(self, data_path_patient):
-        """Load patient data from path"""
-
-        for nerve_class in [_CLASS_MEDIANUS, _CLASS_ULNARIS, _CLASS_RADIALIS]:
-
-            # OPUS data 2/3 contains 'OPUS' for image_list, 'ROI' for labels_list
-            # NOTE: OPUS data additionally contains 'reconOA' for image_list, 'reconUS' for us_list
-            opus_path = os.path.join(data_path_patient, nerve_class, 'OPUS')
-            roi_path = os.path.join(data_path_patient, nerve_class, 'ROI')
-
-            # Load image and class
-            label_files = os.listdir(roi_path)
-            for img_filename in os.listdir(opus_path):
-                if not img_filename.startswith(('.', '@')):
-                    img_case_num, img_id = self._parse_sample_filename(
-                        img_filename)
-                    if img_case_num is not None:
-                        for label_filename in label_files:
-                            label_case_num, label_id = self._parse_sample_filename(
-                                label_filename)
-
-                            # If the image and label files have the same case number and id
-                            if img_case_num == label_case_num and img_id == label_id:
-                                self.image_list.append(
-                                    os.path.join(opus_path, img_filename))
-                                self.classes_list.append(class_str_to_index(nerve_class))
-                                self.labels_list.append(
-                                    os.path.join(roi_path, label_filename))
-                                break
-
-    def _parse_sample_filename(self, filename):
-        # regular expression for the image/label number in the filenames
-        # Example: 'OPUS_NNMF_48_05.mat' where '48' is the case number (group 4) and '05' is the sample id (group 5) and
-        # group 2 is '_48_05.'
-        file_re = r'(\w+)(_((\d+)_(\d+))\.)\w+$'
-
-        matches = re.search(file_re, filename)
-
-        if matches is not None and matches.group(2) is not None:
-            case_num = int(matches.group(4))
-            sample_id = int(matches.group(5))
+    def _foreground_boxes(self):
+        """Relative foreground bounding boxes of all samples as an [N x 4] array, NaN without foreground"""
+        boxes = np.full((len(self.labels_list), 4), np.nan, dtype=np.float32)
+        for idx in range(len(self.labels_list)):
+            if self.store is not None and 'foreground_box' in self.store.samples[self.store_idx_list[idx]]:
+                # precomputed by write_opus_store
+                box = self.store.samples[self.store_idx_list[idx]]['foreground_box']
+            else:
+                box = foreground_box(self._load_sample(idx)['labels'])
+            if box is not None:
+                boxes[idx] = box
+        return boxes
+
+    def full_frame(self):
+        """A view of the dataset without patch mode, e.g. for validation"""
+        dataset = copy.copy(self)
+        dataset.patch_sampler = None
+        return dataset
+
+    def _random_patch(self, idx, image, labels):
+        box = self.foreground_boxes[idx]
+        top, left = self.patch_sampler(labels.shape[-2:], None if np.isnan(box[0]) else box)
+        ph, pw = self.patch_sampler.patch_size
+        return image[..., top:top + ph, left:left + pw], labels[..., top:top + ph, left:left + pw]
+
+    def _build_transform_cache(self):
+        self.transform_cache = None
+        transform_cache = CachedTransform(self.transform, self.transform_cache_dir)
+        if transform_cache.enabled:
+            self.transform_cache = transform_cache
+            if transform_cache.in_memory:
+                # DataLoader workers do not share memory with the main process,
+                # so an in-memory cache has to be filled before they are forked
+                self.precompute_transforms()
+
+    def set_input_size(self, input_size):
+        """Changes the output size of the Rescale transforms, the transform cache follows"""
+        transform_list = self.transform.transforms if isinstance(self.transform, transforms.Compose) else [self.transform]
+        for t in transform_list:
+            if isinstance(t, Rescale):
+                t.output_size = input_size
+
+        if self.transform_cache is not None:
+            self._build_transform_cache()
+
+    def channel_statistics(self):
+        """
+        Per-channel mean and std over all pixels of the images of the dataset. Computed
+        once and stored with the manifest, recomputed for a sample store.
+        """
+        if self.manifest is None:
+            statistics = self._compute_channel_statistics()
         else:
-            case_num = None
-            sample_id = None
-
-        return case_num, sample_id
+            statistics = self.manifest.cached_statistics('channel_statistics', self.patients_list,
+                                                         self._compute_channel_statistics)
+            self.manifest.save()
+        return statistics['mean'], statistics['std']
+
+    def _compute_channel_statistics(self):
+        print("Computing the channel statistics of " + ", ".join(self.patients_list))
+        n_pixels, total, total_sq = 0, 0, 0
+        for idx in range(len(self)):
+            image = self._load_sample(idx)['image']
+            pixels = image.reshape(-1, image.shape[-1])
+            n_pixels += len(pixels)
+            # float64 accumulators, the sums run over millions of pixels
+            total = total + pixels.sum(axis=0, dtype=np.float64)
+            total_sq = total_sq + np.einsum('ij,ij->j', pixels, pixels, dtype=np.float64)
+
+        mean = total / n_pixels
+        std = np.sqrt(np.maximum(total_sq / n_pixels - mean ** 2, 0))
+        # constant channels are only shifted
+        std[std == 0] = 1
+        return {'mean': mean.tolist(), 'std': std.tolist()}
+
+    def enable_read_ahead(self, max_samples, keep_data=True):
+        """
+        Reads the files announced with prefetch in background threads (see data_loaders.read_ahead).
+        max_samples: maximum number of announced samples whose files are kept
+        keep_data: keep the contents for _load_sample in this process, otherwise only
+                   the page cache is filled for the DataLoader workers
+        """
+        if self.read_ahead is None:
+            # an image and a label file per sample
+            resolve = self.staging.stage if self.staging is not None else None
+            self.read_ahead = FileReadAhead(2 * max_samples, keep_data=keep_data, resolve=resolve)
+
+    def prefetch(self, indices):
+        """Announces the samples that are loaded next, e.g. by base.ReadAheadSampler"""
+        # store and bank samples are memory-mapped
+        if self.read_ahead is None or self.store is not None or self.augmentation_bank is not None:
+            return
+        paths = []
+        for idx in indices:
+            paths += [self.image_list[idx], self.labels_list[idx]]
+        self.read_ahead.schedule(paths)
+
+    def _load_file(self, path, dtype=None):
+        data = self.read_ahead.take(path) if self.read_ahead is not None else None
+        return load_files(path, dtype=dtype, data=data, staging=self.staging)
+
+    def _share_memory(self):
+        """Keep the path tables in shared memory instead of Python lists, so they are not copied into every worker"""
+        self.image_list = SharedStringTable(self.image_list)
+        self.labels_list = SharedStringTable(self.labels_list)
+        self.store_idx_list = np.array(self.store_idx_list, dtype=np.int64)
+
+    def _load_patient(self, patient):
+        """Load patient data from the manifest"""
+
+        for sample in self.manifest.patient_samples(patient):
+            self.image_list.append(sample['image_path'])
+            self.classes_list.append(class_str_to_index(sample['nerve_class']))
+            self.labels_list.append(sample['label_path'])
+
+    def _load_patient_from_store(self, patient):
+        """Load the store indices of all samples that belong to the patient"""
+
+        for store_idx, sample in enumerate(self.store.samples):
+            if sample['patient'] == patient:
+                self.image_list.append(sample['image_path'])
+                self.classes_list.append(sample['class_index'])
+                self.labels_list.append(sample['label_path'])
+                self.store_idx_list.append(store_idx)
 
     def __len__(self):
         return len(self.labels_list)
 
-    def __getitem__(self, idx):
-
-        image = load_files(self.image_list[idx])
-        labels = load_files(self.labels_list[idx])
-        cl = self.classes_list[idx]
+    def precompute_transforms(self):
+        """Applies the deterministic transforms to all samples once and caches the results"""
+        for idx in range(len(self)):
+            self.transform_cache(self.image_list[idx], lambda: self._load_sample(idx))
+
+    def _load_sample(self, idx):
+        if self.store is not None:
+            # zero-copy image views into the memory-mapped store
+            image, labels = self.store[self.store_idx_list[idx]]
+            if image.dtype != self.dtype:
+                image = image.astype(self.dtype)
+        else:
+            image = self._load_file(self.image_list[idx], dtype=self.dtype)
+            labels = self._load_file(self.labels_list[idx])
 
+        # uint8 {0, 1} masks, the label transforms keep them in integer space
+        labels = label_mask(labels)
         if labels.ndim < 3:
             labels = np.expand_dims(labels, axis=2)
 
         # US only: change image to us, dict
-        sample = {'image': image, 'labels': labels}
-        if self.transform:
-            sample = self.transform(sample)
+        return {'image': image, 'labels': labels}
+
+    def __getitem__(self, idx):
+
+        cl = self.classes_list[idx]
+
+        if self.augmentation_bank is not None:
+            sample = self.augmentation_bank.sample(idx)
+        elif self.transform_cache is not None:
+            sample = self.transform_cache(self.image_list[idx], lambda: self._load_sample(idx))
+        else:
+            sample = self._load_sample(idx)
+            if self.transform:
+                sample = self.transform(sample)
 
         # TODO: Need to break apart dictionary and squeeze data so that it fits into the framework. Modify framework to
         #  accept sample tuple
         sample['labels'] = sample['labels'].squeeze()
+        if self.patch_sampler is not None:
+            sample['image'], sample['labels'] = self._random_patch(idx, sample['image'], sample['labels'])
         if self.with_idx:
             return sample['image'].float(), sample['labels'].float(), cl, idx
         return sample['image'].float(), sample['labels'].float(), cl
@@ -203,10 +392,14 @@ class OPUSDataset(Dataset):
 
 
 class RandomHorizontalFlip(object):
+    deterministic = False
 
     def __init__(self, p):
         self.p = p
 
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={})'.format(self.p)
+
     def __call__(self, data):
         img = data['image']
         lab = data['labels']
@@ -219,34 +412,43 @@ class RandomHorizontalFlip(object):
 
 
 class elastic_deform(object):
+    deterministic = False
 
     def __init__(self, p):
         self.p = p
 
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={})'.format(self.p)
+
     def __call__(self, data):
         img = data['image']
         lab = data['labels']
 
-        x_coo = np.random.randint(100, 300)
-        y_coo = np.random.randint(100, 300)
-        dx = np.random.randint(10, 40)
-        dy = np.random.randint(10, 40)
         if random.random() < self.p:
-            img = elastic_deformation(img, x_coo, y_coo, dx, dy)
-            lab = elastic_deformation(lab, x_coo, y_coo, dx, dy)
+            x_coo = np.random.randint(100, 300)
+            y_coo = np.random.randint(100, 300)
+            dx = np.random.randint(10, 40)
+            dy = np.random.randint(10, 40)
 
-            lab = np.where(lab <= 20, 0, lab)
-            lab = np.where(lab > 20, 255, lab)
+            # image and labels share the displacement field
+            displacement = elastic_displacement(img.shape, x_coo, y_coo, dx, dy)
+            img = apply_displacement(img, displacement)
+            # nearest neighbour, so the label mask stays binary
+            lab = apply_displacement(lab, displacement, order=0)
 
         return {'image': img, 'labels': lab}
 
 
 class Rescale(object):
+    deterministic = True
 
     def __init__(self, output_size):
         assert isinstance(output_size, (int, tuple))
         self.output_size = output_size
 
+    def __repr__(self):
+        return self.__class__.__name__ + '(output_size={})'.format(self.output_size)
+
     def __call__(self, sample):
         image, labels = sample['image'], sample['labels']
 
@@ -264,37 +466,66 @@ class Rescale(object):
         new_h, new_w = int(new_h), int(new_w)
 
         img = transform.resize(image, (new_h, new_w, d), mode='constant')
-        labels = transform.resize(labels, (new_h, new_w), mode='constant')
-
-        labels = np.where(labels <= 0.5, 0, 1)  # for loss function
+        if np.issubdtype(image.dtype, np.floating):
+            # older skimage versions compute and return float64 for every input
+            img = img.astype(image.dtype, copy=False)
+        # nearest neighbour, the {0, 1} label mask is used as is by the loss function
+        labels = resize_mask(labels, (new_h, new_w))
 
         return {'image': img, 'labels': labels}
 
 
 class ToTensor(object):
+    """
+    mean, std: per-channel statistics (see OPUSDataset.channel_statistics) to normalize
+               the images with. Every image is min-max normalized by itself (utils.norm) if None.
+    """
+    deterministic = True
+
+    def __init__(self, mean=None, std=None):
+        self.mean = mean
+        self.std = std
+        if mean is not None:
+            self._mean = np.asarray(mean, dtype=np.float32).reshape(-1, 1, 1)
+            self._inv_std = 1 / np.asarray(std, dtype=np.float32).reshape(-1, 1, 1)
+
+    def __repr__(self):
+        if self.mean is None:
+            return self.__class__.__name__ + '()'
+        return self.__class__.__name__ + '(mean={}, std={})'.format(self.mean, self.std)
+
     def __call__(self, sample):
         image, labels = sample['image'], sample['labels']
 
-        image = norm(image)
-
-        image = image.transpose((2, 0, 1))
+        if self.mean is None:
+            image = norm(image)
+            image = image.transpose((2, 0, 1))
+        else:
+            # normalization, float32 conversion and the channel-first copy in a single pass
+            image = np.subtract(image.transpose((2, 0, 1)), self._mean, dtype=np.float32, order='C')
+            image *= self._inv_std
 
         return {'image': torch.from_numpy(image),
                 'labels': torch.from_numpy(labels)}
 
 
 class NumpyNormalize(object):
+    deterministic = True
+
     def __init__(self, mean, std):
         self.mean = mean
         self.std = std
+        # channel-first like transforms.Normalize
+        self._mean = np.asarray(mean, dtype=np.float32).reshape(-1, 1, 1)
+        self._std = np.asarray(std, dtype=np.float32).reshape(-1, 1, 1)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={}, std={})'.format(self.mean, self.std)
 
     def __call__(self, sample):
         image, labels = sample['image'], sample['labels']
 
-        transform = transforms.Normalize(mean=self.mean, std=self.std)
-
-        image = (transform(torch.from_numpy(image))).numpy()
-
+        image = (image - self._mean) / self._std
 
         return {'image': image, 'labels': labels}
 
@@ -314,36 +545,146 @@ class OPUSDataLoader(BaseDataLoader):
                  input_size=400,
                  augmentation_probability=0.5,
                  with_idx=False,
-                 cross_val=None):
+                 cross_val=None,
+                 store_dir=None,
+                 manifest_path=None,
+                 cache_transforms=False,
+                 transform_cache_dir=None,
+                 shared_memory=False,
+                 batch_augmentation=False,
+                 flip_probability=0.0,
+                 augmentation_bank_dir=None,
+                 augmentation_bank_variants=4,
+                 augmentation_bank_refresh=0,
+                 persistent_workers=False,
+                 patch_size=None,
+                 patch_foreground_fraction=0.5,
+                 importance_sampling=None,
+                 dtype=DEFAULT_DTYPE,
+                 normalization='minmax',
+                 read_ahead=0,
+                 staging_dir=None,
+                 staging_budget_gb=None):
 
         self.data_dir = data_dir
         self.input_size = input_size
+        # resolution of the training samples, changed by a resolution schedule (see set_input_size)
+        self.train_input_size = input_size
         self.augmentation_probability = augmentation_probability
         self.with_idx = with_idx
         self.cross_val = cross_val
+        self.store_dir = store_dir
+        self.manifest_path = manifest_path
+        self.cache_transforms = cache_transforms
+        self.transform_cache_dir = transform_cache_dir
+        self.shared_memory = shared_memory
+        self.dtype = dtype
+        self.staging_dir = staging_dir
+        self.staging_budget_gb = staging_budget_gb
+
+        # 'minmax': every image is normalized by itself,
+        # 'dataset': the channel statistics of the training patients are used for all phases
+        if normalization == 'dataset':
+            statistics_dataset = OPUSDataset('train', data_path=data_dir, cross_val=cross_val, store_dir=store_dir,
+                                             manifest_path=manifest_path, dtype=dtype, staging_dir=staging_dir,
+                                             staging_budget_gb=staging_budget_gb)
+            self.channel_mean, self.channel_std = statistics_dataset.channel_statistics()
+        elif normalization == 'minmax':
+            self.channel_mean, self.channel_std = None, None
+        else:
+            raise ValueError("Unknown normalization '{}', use 'minmax' or 'dataset'".format(normalization))
+
+        # Post-collate augmentation, applied by the trainer on the device (see data_loaders.batch_transforms)
+        self.batch_transform = None
 
         if training:
-            self.dataset = OPUSDataset('train', data_path=data_dir, with_idx=with_idx, cross_val=cross_val, transform=transforms.Compose([
-                elastic_deform(augmentation_probability),
+            if batch_augmentation:
+                augmentation = []
+                self.batch_transform = BatchCompose([BatchElasticDeform(augmentation_probability),
+                                                     BatchRandomHorizontalFlip(flip_probability)])
+            else:
+                augmentation = [elastic_deform(augmentation_probability)]
+                if flip_probability > 0:
+                    augmentation.append(RandomHorizontalFlip(flip_probability))
+
+            self.dataset = OPUSDataset('train', data_path=data_dir, with_idx=with_idx, cross_val=cross_val, store_dir=store_dir,
+                                       manifest_path=manifest_path, cache_transforms=cache_transforms,
+                                       transform_cache_dir=transform_cache_dir, shared_memory=shared_memory,
+                                       patch_size=patch_size, foreground_fraction=patch_foreground_fraction, dtype=dtype,
+                                       staging_dir=staging_dir, staging_budget_gb=staging_budget_gb,
+                                       transform=transforms.Compose(augmentation + [
                 Rescale(input_size),
-                ToTensor()
+                ToTensor(self.channel_mean, self.channel_std)
                 ]))
         else:
-            self.dataset = OPUSDataset('test', data_path=data_dir, with_idx=with_idx, cross_val=cross_val, transform=transforms.Compose([
+            self.dataset = OPUSDataset('test', data_path=data_dir, with_idx=with_idx, cross_val=cross_val, store_dir=store_dir,
+                                       manifest_path=manifest_path, cache_transforms=cache_transforms,
+                                       transform_cache_dir=transform_cache_dir, shared_memory=shared_memory,
+                                       dtype=dtype, staging_dir=staging_dir, staging_budget_gb=staging_budget_gb,
+                                       transform=transforms.Compose([
                 Rescale(input_size),
-                ToTensor()
+                ToTensor(self.channel_mean, self.channel_std)
             ]))
 
+        # Serve the training samples from K pre-generated augmented variants,
+        # refreshing augmentation_bank_refresh of them in the background every epoch
+        self.augmentation_bank = None
+        self.augmentation_bank_refresh = augmentation_bank_refresh
+        if training and augmentation_bank_dir is not None:
+            self.augmentation_bank = AugmentationBank(augmentation_bank_dir, augmentation_bank_variants)
+            self.augmentation_bank.build(self.dataset, num_workers)
+            self.dataset.augmentation_bank = self.augmentation_bank
+
+        if importance_sampling is not None and not with_idx:
+            raise ValueError("importance_sampling needs the dataset indices in the batches, set with_idx")
+
         super().__init__(self.dataset, batch_size, shuffle,
-                         validation_split, num_workers, test_config=None)
+                         validation_split, num_workers, test_config=None, persistent_workers=persistent_workers,
+                         importance_sampling=importance_sampling, read_ahead=read_ahead)
+
+    def __iter__(self):
+        iterator = super().__iter__()
+        # start after the workers of this epoch got the current bank
+        if self.augmentation_bank is not None:
+            self.augmentation_bank.refresh_async(self.dataset, self.augmentation_bank_refresh,
+                                                 self.init_kwargs['num_workers'])
+        return iterator
+
+    def set_input_size(self, input_size):
+        """
+        Changes the resolution of the training samples, e.g. for the resolution_schedule of
+        the trainer. The validation samples keep the configured input_size.
+        """
+        if input_size == self.train_input_size:
+            return
+        self.train_input_size = input_size
+        self.dataset.set_input_size(input_size)
+
+        if self.augmentation_bank is not None:
+            # the variants are stored at the resolution they were generated with
+            self.augmentation_bank.wait()
+            self.augmentation_bank.build(self.dataset, self.init_kwargs['num_workers'])
+        if self.worker_pool is not None:
+            # restarts the workers, their copies of the dataset have the old resolution
+            self.worker_pool.add_dataset('train', self.dataset, self.collate_fn)
 
     def split_validation(self):
         transformed_dataset_val = OPUSDataset('val', self.data_dir,
                                               with_idx=self.with_idx,
                                               cross_val=self.cross_val,
+                                              store_dir=self.store_dir,
+                                              manifest_path=self.manifest_path,
+                                              cache_transforms=self.cache_transforms,
+                                              transform_cache_dir=self.transform_cache_dir,
+                                              shared_memory=self.shared_memory,
+                                              dtype=self.dtype,
+                                              staging_dir=self.staging_dir,
+                                              staging_budget_gb=self.staging_budget_gb,
                                               transform=transforms.Compose([
                                                   Rescale(self.input_size),
-                                                  ToTensor()]))
+                                                  ToTensor(self.channel_mean, self.channel_std)]))
         batch_size = self.init_kwargs['batch_size']
         num_workers = self.init_kwargs['num_workers']
-        return DataLoader(transformed_dataset_val, batch_size=batch_size, num_workers=num_workers, shuffle=True)
+        sampler = self._read_ahead_sampler(transformed_dataset_val, shuffle=True)
+        return self._phase_loader('val', transformed_dataset_val, batch_size=batch_size, num_workers=num_workers,
+                                  shuffle=sampler is None, sampler=sampler)
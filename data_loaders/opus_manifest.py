@@ -0,0 +1,190 @@
+import hashlib
+import os
+import re
+
+from utils import read_json, write_json
+
+# =============================================================================
+# OPUS dataset manifest
+# Pairs image and label files once per patient folder and keeps the result
+# (patient, nerve class, case number, sample id, paths, file sizes and mtimes)
+# on disk. A patient is re-indexed when one of its OPUS/ROI folders changed
+# (files added, removed or renamed) or one of its files was rewritten in place.
+# Dataset statistics (e.g. the channel statistics of the training patients)
+# are kept alongside, keyed by the image files they were computed from.
+# =============================================================================
+
+_MANIFEST_VERSION = 2
+
+# regular expression for the image/label number in the filenames
+# Example: 'OPUS_NNMF_48_05.mat' where '48' is the case number (group 4) and '05' is the sample id (group 5) and
+# group 2 is '_48_05.'
+_FILE_RE = re.compile(r'(\w+)(_((\d+)_(\d+))\.)\w+$')
+
+
+def parse_sample_filename(filename):
+    matches = _FILE_RE.search(filename)
+
+    if matches is not None and matches.group(2) is not None:
+        case_num = int(matches.group(4))
+        sample_id = int(matches.group(5))
+    else:
+        case_num = None
+        sample_id = None
+
+    return case_num, sample_id
+
+
+def _sample_dirs(nerve_class):
+    # OPUS data 2/3 contains 'OPUS' for image_list, 'ROI' for labels_list
+    # NOTE: OPUS data additionally contains 'reconOA' for image_list, 'reconUS' for us_list
+    return os.path.join(nerve_class, 'OPUS'), os.path.join(nerve_class, 'ROI')
+
+
+def pair_patient_files(data_path_patient, nerve_classes):
+    """
+    Pairs the OPUS images of a patient folder with their ROI labels. The label
+    files are indexed by (case number, sample id) first, so every file name is
+    parsed exactly once.
+
+    Returns a list of dicts with the keys 'nerve_class', 'case_num', 'sample_id',
+    'image_path' and 'label_path'.
+    """
+    pairs = []
+    for nerve_class in nerve_classes:
+        opus_dir, roi_dir = _sample_dirs(nerve_class)
+        opus_path = os.path.join(data_path_patient, opus_dir)
+        roi_path = os.path.join(data_path_patient, roi_dir)
+
+        # the first label file in listing order wins if several share a key
+        labels_by_key = {}
+        for label_filename in os.listdir(roi_path):
+            key = parse_sample_filename(label_filename)
+            if key[0] is not None:
+                labels_by_key.setdefault(key, label_filename)
+
+        for img_filename in os.listdir(opus_path):
+            if not img_filename.startswith(('.', '@')):
+                key = parse_sample_filename(img_filename)
+                if key[0] is not None and key in labels_by_key:
+                    pairs.append({'nerve_class': nerve_class,
+                                  'case_num': key[0],
+                                  'sample_id': key[1],
+                                  'image_path': os.path.join(opus_path, img_filename),
+                                  'label_path': os.path.join(roi_path, labels_by_key[key])})
+    return pairs
+
+
+class OPUSManifest(object):
+    """
+    Manifest of the paired OPUS samples of a data folder.
+
+    data_path: root folder of the OPUS data containing the patient_xxx folders
+    nerve_classes: nerve class folders of every patient
+    manifest_path: json file the manifest is persisted to, kept in memory only if None
+    """
+
+    def __init__(self, data_path, nerve_classes, manifest_path=None):
+        self.data_path = data_path
+        self.nerve_classes = list(nerve_classes)
+        self.manifest_path = manifest_path
+        self.patients = {}
+        self.statistics = {}
+        self._changed = False
+
+        if manifest_path is not None and os.path.isfile(manifest_path):
+            manifest = read_json(manifest_path)
+            if manifest.get('version') == _MANIFEST_VERSION and manifest.get('nerve_classes') == self.nerve_classes:
+                self.patients = manifest['patients']
+                self.statistics = manifest.get('statistics', {})
+
+    def _dir_mtimes(self, patient):
+        mtimes = {}
+        for nerve_class in self.nerve_classes:
+            for sample_dir in _sample_dirs(nerve_class):
+                mtimes[sample_dir] = os.stat(os.path.join(self.data_path, patient, sample_dir)).st_mtime
+        return mtimes
+
+    def _index_patient(self, patient, dir_mtimes):
+        data_path_patient = os.path.join(self.data_path, patient)
+
+        samples = []
+        for pair in pair_patient_files(data_path_patient, self.nerve_classes):
+            pair['patient'] = patient
+            image_stat, label_stat = os.stat(pair['image_path']), os.stat(pair['label_path'])
+            pair['image_mtime'], pair['image_size'] = image_stat.st_mtime, image_stat.st_size
+            pair['label_mtime'], pair['label_size'] = label_stat.st_mtime, label_stat.st_size
+            # paths are kept relative, so the manifest stays valid if the data is mounted elsewhere
+            pair['image_path'] = os.path.relpath(pair['image_path'], self.data_path)
+            pair['label_path'] = os.path.relpath(pair['label_path'], self.data_path)
+            samples.append(pair)
+
+        self.patients[patient] = {'dir_mtimes': dir_mtimes, 'samples': samples}
+        self._changed = True
+
+    def _files_unchanged(self, entry):
+        # rewriting a file in place leaves the mtime of its folder unchanged
+        for sample in entry['samples']:
+            for kind in ('image', 'label'):
+                try:
+                    stat = os.stat(os.path.join(self.data_path, sample[kind + '_path']))
+                except FileNotFoundError:
+                    return False
+                if stat.st_mtime != sample[kind + '_mtime'] or stat.st_size != sample[kind + '_size']:
+                    return False
+        return True
+
+    def patient_samples(self, patient):
+        """
+        Returns the samples of the patient with absolute paths. The patient is
+        re-indexed if files were added, removed, renamed or modified in its folders.
+        """
+        dir_mtimes = self._dir_mtimes(patient)
+        entry = self.patients.get(patient)
+        if entry is None or entry['dir_mtimes'] != dir_mtimes or not self._files_unchanged(entry):
+            self._index_patient(patient, dir_mtimes)
+            entry = self.patients[patient]
+
+        samples = []
+        for sample in entry['samples']:
+            sample = dict(sample)
+            sample['image_path'] = os.path.join(self.data_path, sample['image_path'])
+            sample['label_path'] = os.path.join(self.data_path, sample['label_path'])
+            samples.append(sample)
+        return samples
+
+    def _statistics_key(self, name, patients):
+        # changes whenever an image of the patients is added, removed or modified
+        content = [name]
+        for patient in sorted(patients):
+            for sample in self.patient_samples(patient):
+                content.append('{}:{}:{}'.format(os.path.relpath(sample['image_path'], self.data_path),
+                                                 sample['image_mtime'], sample['image_size']))
+        return hashlib.sha1('\n'.join(content).encode('utf-8')).hexdigest()
+
+    def cached_statistics(self, name, patients, compute):
+        """
+        Returns the statistics called name of the samples of the patients. They are
+        computed by compute() only if they were not stored for the same image files.
+        """
+        # one entry per set of files, e.g. for the training patients of every cross validation fold
+        key = self._statistics_key(name, patients)
+        if key not in self.statistics:
+            self.statistics[key] = {'name': name, 'patients': sorted(patients), 'values': compute()}
+            self._changed = True
+        return self.statistics[key]['values']
+
+    def save(self):
+        """Writes the manifest if any patient was (re-)indexed"""
+        if self.manifest_path is None or not self._changed:
+            return
+
+        # write and rename, so concurrent runs (e.g. cross validation folds) never read a partial file
+        tmp_path = self.manifest_path + '.tmp{}'.format(os.getpid())
+        write_json({'version': _MANIFEST_VERSION,
+                    'nerve_classes': self.nerve_classes,
+                    'patients': self.patients,
+                    'statistics': self.statistics},
+                   tmp_path)
+        os.replace(tmp_path, self.manifest_path)
+        self._changed = False
@@ -0,0 +1,338 @@
+import io
+import itertools
+import json
+import os
+import random
+import tarfile
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from data_loaders.label_mask import label_mask, pack_mask, unpack_mask
+from data_loaders.opus_dataloader import (DEFAULT_DTYPE, RandomHorizontalFlip, Rescale, ToTensor, elastic_deform,
+                                          list_opus_samples)
+from utils import ensure_dir, load_files, read_json, write_json
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    # torch < 1.2, the other data loaders keep working, only streaming from shards is unavailable
+    IterableDataset, get_worker_info = object, None
+
+# =============================================================================
+# Sharded OPUS dataset
+# The samples are packed into tar shards that are read front to back as
+# streams, never with random access. A shard holds the samples of a single
+# patient, so the phases select their shards by patient. Per sample:
+# <key>.image.npy:   float32 image [H x W x C]
+# <key>.labels.bits: bit-packed ROI mask (see data_loaders.label_mask)
+# <key>.json:        sample index, patient, nerve class, class index,
+#                    label shape and source paths
+# index.json:        patient and number of samples of every shard
+# =============================================================================
+
+_INDEX_FILENAME = 'index.json'
+_SHARD_FILENAME = 'shard_{:06d}.tar'
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_opus_shards(samples, shard_dir, samples_per_shard=100):
+    """
+    Packs the samples into sequential tar shards.
+
+    samples: list of dicts with the keys 'patient', 'nerve_class', 'class_index',
+             'image_path' and 'label_path' (see list_opus_samples)
+    shard_dir: folder the shards are written to
+    samples_per_shard: maximum number of samples per shard
+    """
+    ensure_dir(shard_dir)
+
+    shards = []
+    tar = None
+    # the samples of a patient are kept together, in their original order
+    samples = sorted(samples, key=lambda sample: sample['patient'])
+    for sample_idx, sample in enumerate(samples):
+        if tar is None or shards[-1]['patient'] != sample['patient'] or shards[-1]['n_samples'] == samples_per_shard:
+            if tar is not None:
+                tar.close()
+                os.replace(shard_path + '.tmp', shard_path)
+            shard_path = os.path.join(shard_dir, _SHARD_FILENAME.format(len(shards)))
+            tar = tarfile.open(shard_path + '.tmp', mode='w')
+            shards.append({'filename': os.path.basename(shard_path), 'patient': sample['patient'], 'n_samples': 0})
+
+        image = np.ascontiguousarray(load_files(sample['image_path'], dtype=np.float32))
+        labels = label_mask(load_files(sample['label_path']))
+
+        key = '{:08d}'.format(sample_idx)
+        image_buffer = io.BytesIO()
+        np.save(image_buffer, image)
+        _add_member(tar, key + '.image.npy', image_buffer.getvalue())
+        _add_member(tar, key + '.labels.bits', pack_mask(labels).tobytes())
+        _add_member(tar, key + '.json', json.dumps({'index': sample_idx,
+                                                    'patient': sample['patient'],
+                                                    'nerve_class': sample['nerve_class'],
+                                                    'class_index': sample['class_index'],
+                                                    'label_shape': list(labels.shape),
+                                                    'image_path': sample['image_path'],
+                                                    'label_path': sample['label_path']}).encode('utf-8'))
+        shards[-1]['n_samples'] += 1
+
+    if tar is not None:
+        tar.close()
+        os.replace(shard_path + '.tmp', shard_path)
+
+    # The index is written last, so an interrupted conversion never leaves usable shards behind
+    write_json({'n_samples': len(samples), 'shards': shards}, os.path.join(shard_dir, _INDEX_FILENAME))
+
+
+def convert_opus_shards(data_path, shard_dir, patients_list=None, manifest_path=None, samples_per_shard=100):
+    """
+    One-time conversion of the OPUS patient folders into tar shards, which
+    OPUSShardDataLoader streams from. The other arguments are those of list_opus_samples.
+    """
+    write_opus_shards(list_opus_samples(data_path, patients_list, manifest_path), shard_dir, samples_per_shard)
+
+
+def _decode_sample(parts):
+    meta = json.loads(parts['json'].decode('utf-8'))
+    image = np.load(io.BytesIO(parts['image.npy']))
+    labels = unpack_mask(np.frombuffer(parts['labels.bits'], dtype=np.uint8), meta['label_shape'])
+    return meta, image, labels
+
+
+def read_shard(path):
+    """Yields the (meta, image, labels) samples of a shard, reading the tar file as a stream"""
+    with tarfile.open(path, mode='r|') as tar:
+        key, parts = None, {}
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, suffix = member.name.split('.', 1)
+            if member_key != key:
+                if parts:
+                    yield _decode_sample(parts)
+                key, parts = member_key, {}
+            parts[suffix] = tar.extractfile(member).read()
+        if parts:
+            yield _decode_sample(parts)
+
+
+def _shuffle_buffer(samples, buffer_size, rng):
+    """Approximate shuffle of a stream: every sample waits in a buffer and leaves it at a random time"""
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    for sample in buffer:
+        yield sample
+
+
+def _balance_shards(shards, world_size):
+    """
+    Splits the shards across the ranks, balanced by their number of samples: the largest
+    shards first, each to the rank with the fewest samples so far. The shards of a rank
+    keep the order of the index.
+    """
+    order = sorted(range(len(shards)), key=lambda i: -shards[i]['n_samples'])
+    rank_indices = [[] for _ in range(world_size)]
+    loads = [0] * world_size
+    for i in order:
+        rank = loads.index(min(loads))
+        rank_indices[rank].append(i)
+        loads[rank] += shards[i]['n_samples']
+    return [[shards[i] for i in sorted(indices)] for indices in rank_indices]
+
+
+def _split_samples(n_samples, capacities):
+    """
+    Splits n_samples across the workers in proportion to the number of samples of their
+    shards (capacities), no worker gets more than it has
+    """
+    total = sum(capacities)
+    counts = [n_samples * capacity // total if total else 0 for capacity in capacities]
+    while sum(counts) < n_samples:
+        for i, capacity in enumerate(capacities):
+            if counts[i] < capacity and sum(counts) < n_samples:
+                counts[i] += 1
+    return counts
+
+
+class OPUSShardDataset(IterableDataset):
+    """
+    Streams the samples of the shards of a set of patients.
+
+    The shards are split across the ranks (distributed training) and then across
+    the DataLoader workers, so every sample is read at most once per epoch. The
+    ranks are balanced by their number of samples and all serve as many samples
+    as the smallest one, the rest of the larger ranks is dropped from the epoch
+    (which samples, changes every epoch with shuffle). With shuffle,
+    the shard order changes every epoch (see set_epoch) and the samples pass a
+    shuffle buffer. The buffer holds untransformed samples, mind its memory
+    (shuffle_buffer x image size) in every worker.
+
+    shard_dir: folder written by write_opus_shards
+    patients: patients to stream, all patients if None
+    rank, world_size: distributed rank and number of ranks, from torch.distributed if None
+    """
+
+    def __init__(self, shard_dir, patients=None, transform=None, with_idx=False, shuffle=True, shuffle_buffer=32,
+                 seed=0, rank=None, world_size=None, dtype=DEFAULT_DTYPE):
+        if get_worker_info is None:
+            raise ImportError("Streaming OPUS shards needs iterable datasets (torch >= 1.2), "
+                              "torch {} is installed".format(torch.__version__))
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.with_idx = with_idx
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.dtype = np.dtype(dtype)
+        self.epoch = 0
+
+        if rank is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            rank = dist.get_rank() if distributed else 0
+            world_size = dist.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size if world_size is not None else 1
+
+        index = read_json(os.path.join(shard_dir, _INDEX_FILENAME))
+        shards = [shard for shard in index['shards'] if patients is None or shard['patient'] in patients]
+        if shards and len(shards) < self.world_size:
+            raise ValueError("{} shards cannot be split across {} ranks, write smaller shards "
+                             "(samples_per_shard)".format(len(shards), self.world_size))
+        rank_shards = _balance_shards(shards, self.world_size)
+        # a fixed assignment, so every rank serves the same shards in every epoch
+        self.shards = rank_shards[rank]
+        # all ranks serve the same number of samples (or distributed training waits for the rank with
+        # more batches), the samples the other ranks do not reach are dropped from each epoch
+        self.n_samples = min(sum(shard['n_samples'] for shard in shards) for shards in rank_shards)
+        self.patients = sorted(set(shard['patient'] for shard in self.shards))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.n_samples
+
+    def _worker_shards(self):
+        shards = list(self.shards)
+        if self.shuffle:
+            # the same order in all workers, which then take every num_workers-th shard
+            random.Random(self.seed + self.epoch).shuffle(shards)
+
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        worker_shards = [shards[i::num_workers] for i in range(num_workers)]
+        n_samples = _split_samples(self.n_samples, [sum(shard['n_samples'] for shard in shards)
+                                                    for shards in worker_shards])
+        return worker_shards[worker_id], n_samples[worker_id], worker_id
+
+    def __iter__(self):
+        shards, n_samples, worker_id = self._worker_shards()
+        samples = (sample for shard in shards for sample in read_shard(os.path.join(self.shard_dir, shard['filename'])))
+        if self.shuffle:
+            rng = random.Random('{}-{}-{}-{}'.format(self.seed, self.epoch, self.rank, worker_id))
+            samples = _shuffle_buffer(samples, self.shuffle_buffer, rng)
+        samples = itertools.islice(samples, n_samples)
+
+        for meta, image, labels in samples:
+            sample = {'image': image.astype(self.dtype, copy=False),
+                      'labels': np.expand_dims(labels, axis=2) if labels.ndim < 3 else labels}
+            if self.transform:
+                sample = self.transform(sample)
+
+            sample['labels'] = sample['labels'].squeeze()
+            if self.with_idx:
+                yield sample['image'].float(), sample['labels'].float(), meta['class_index'], meta['index']
+            else:
+                yield sample['image'].float(), sample['labels'].float(), meta['class_index']
+
+
+class OPUSShardDataLoader(DataLoader):
+    """
+    OPUS data loader streaming from tar shards (see convert_opus_shards), for
+    datasets with more patients than fit into the patient lists of OPUSDataset.
+
+    The patients of val_patients and test_patients are held out, all other
+    patients of the shards are used for training.
+    """
+
+    def __init__(self,
+                 data_dir,
+                 batch_size,
+                 num_workers=1,
+                 training=True,
+                 input_size=400,
+                 augmentation_probability=0.5,
+                 flip_probability=0.0,
+                 with_idx=False,
+                 val_patients=None,
+                 test_patients=None,
+                 shuffle_buffer=32,
+                 seed=0,
+                 rank=None,
+                 world_size=None,
+                 dtype=DEFAULT_DTYPE):
+
+        self.data_dir = data_dir
+        self.input_size = input_size
+        self.with_idx = with_idx
+        self.val_patients = list(val_patients or [])
+        self.test_patients = list(test_patients or [])
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.dtype = dtype
+
+        all_patients = set(shard['patient'] for shard in read_json(os.path.join(data_dir, _INDEX_FILENAME))['shards'])
+        if training:
+            augmentation = [elastic_deform(augmentation_probability)]
+            if flip_probability > 0:
+                augmentation.append(RandomHorizontalFlip(flip_probability))
+            patients = sorted(all_patients - set(self.val_patients) - set(self.test_patients))
+            dataset = self._phase_dataset('train', patients, augmentation, shuffle=True)
+        else:
+            dataset = self._phase_dataset('test', self.test_patients, [], shuffle=False)
+
+        self.n_samples = len(dataset)
+        super().__init__(dataset, batch_size=batch_size, num_workers=num_workers)
+        self._epoch = 0
+
+    def _phase_dataset(self, phase, patients, augmentation, shuffle):
+        dataset = OPUSShardDataset(self.data_dir, patients=patients, with_idx=self.with_idx, shuffle=shuffle,
+                                   shuffle_buffer=self.shuffle_buffer, seed=self.seed, rank=self.rank,
+                                   world_size=self.world_size, dtype=self.dtype,
+                                   transform=transforms.Compose(augmentation + [
+                                       Rescale(self.input_size),
+                                       ToTensor()]))
+        print(phase + " dataset:" + ", ".join(dataset.patients))
+        return dataset
+
+    def __iter__(self):
+        # workers are started per epoch with the dataset as it is now
+        self.dataset.set_epoch(self._epoch)
+        self._epoch += 1
+        return super().__iter__()
+
+    def split_validation(self):
+        if not self.val_patients:
+            return None
+        return DataLoader(self._phase_dataset('val', self.val_patients, [], shuffle=False),
+                          batch_size=self.batch_size, num_workers=self.num_workers)
@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+
+from data_loaders.label_mask import label_mask, pack_mask, packed_size, unpack_mask
+from data_loaders.patch_sampler import foreground_box
+from utils import ensure_dir, load_files, read_json, write_json
+
+# =============================================================================
+# Memory-mapped OPUS sample store
+# images.bin: all images as one contiguous float32 array
+# labels.bin: all ROI labels as bit-packed {0, 1} masks (see data_loaders.label_mask),
+#             stores of older versions keep them as plain uint8
+# index.json: patient, class, source paths, offset and shape and relative
+#             foreground bounding box of every sample
+# =============================================================================
+
+_INDEX_FILENAME = 'index.json'
+_IMAGES_FILENAME = 'images.bin'
+_LABELS_FILENAME = 'labels.bin'
+
+_IMAGE_DTYPE = np.float32
+_LABEL_DTYPE = np.uint8
+_LABEL_ENCODING = 'packbits'
+
+
+def write_opus_store(samples, store_dir):
+    """
+    Parses the .mat files of all samples once and writes them into a
+    contiguous memory-mapped store.
+
+    samples: list of dicts with the keys 'patient', 'nerve_class', 'class_index',
+             'image_path' and 'label_path'
+    store_dir: folder the store is written to
+    """
+    ensure_dir(store_dir)
+
+    index = []
+    image_offset, label_offset = 0, 0
+    with open(os.path.join(store_dir, _IMAGES_FILENAME), 'wb') as f_images, \
+            open(os.path.join(store_dir, _LABELS_FILENAME), 'wb') as f_labels:
+        for sample in samples:
+            image = np.ascontiguousarray(load_files(sample['image_path']), dtype=_IMAGE_DTYPE)
+            labels = label_mask(load_files(sample['label_path']))
+            packed_labels = pack_mask(labels)
+
+            f_images.write(image.tobytes())
+            f_labels.write(packed_labels.tobytes())
+
+            entry = dict(sample)
+            entry.update({'image_offset': image_offset,
+                          'image_shape': list(image.shape),
+                          'label_offset': label_offset,
+                          'label_shape': list(labels.shape),
+                          'foreground_box': foreground_box(labels)})
+            index.append(entry)
+
+            image_offset += image.size
+            label_offset += packed_labels.size
+
+    # The index is written last, so an interrupted conversion never leaves a usable store behind
+    write_json({'image_dtype': np.dtype(_IMAGE_DTYPE).name,
+                'label_dtype': np.dtype(_LABEL_DTYPE).name,
+                'label_encoding': _LABEL_ENCODING,
+                'samples': index},
+               os.path.join(store_dir, _INDEX_FILENAME))
+
+
+class OPUSSampleStore(object):
+    """
+    Read access to a store written by write_opus_store. Images are returned as
+    read-only views of the memory-mapped files, so all DataLoader workers share
+    the data through the page cache. Bit-packed labels are unpacked per sample.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        index = read_json(os.path.join(store_dir, _INDEX_FILENAME))
+        self.image_dtype = np.dtype(index['image_dtype'])
+        self.label_dtype = np.dtype(index['label_dtype'])
+        self.label_encoding = index.get('label_encoding')
+        self.samples = index['samples']
+
+        self._images = None
+        self._labels = None
+
+    def _open(self):
+        # The files are mapped lazily so that every worker process maps them itself
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.store_dir, _IMAGES_FILENAME),
+                                     dtype=self.image_dtype, mode='r')
+            self._labels = np.memmap(os.path.join(self.store_dir, _LABELS_FILENAME),
+                                     dtype=self.label_dtype, mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_labels'] = None
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        self._open()
+        sample = self.samples[idx]
+
+        image_size = int(np.prod(sample['image_shape']))
+        image = self._images[sample['image_offset']:sample['image_offset'] + image_size]
+
+        if self.label_encoding == _LABEL_ENCODING:
+            packed_labels = self._labels[sample['label_offset']:sample['label_offset'] + packed_size(sample['label_shape'])]
+            labels = unpack_mask(packed_labels, sample['label_shape'])
+        else:
+            label_size = int(np.prod(sample['label_shape']))
+            labels = self._labels[sample['label_offset']:sample['label_offset'] + label_size]
+            labels = labels.reshape(sample['label_shape'])
+
+        return image.reshape(sample['image_shape']), labels
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+
+# =============================================================================
+# Foreground-aware patch sampling
+# Foreground bounding boxes are kept as fractions of the label size
+# [top, bottom, left, right], so they stay valid after Rescale.
+# =============================================================================
+
+
+def foreground_box(labels):
+    """
+    Bounding box of the foreground pixels (label > 0.5, as in Rescale) relative
+    to the label size, None if the labels have no foreground.
+    """
+    mask = np.asarray(labels).squeeze() > 0.5
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    h, w = mask.shape
+    return [rows[0] / h, (rows[-1] + 1) / h, cols[0] / w, (cols[-1] + 1) / w]
+
+
+class ForegroundPatchSampler(object):
+    """
+    Draws the position of a random patch. A foreground_fraction of the patches
+    is centered on a random point of the foreground bounding box of the sample,
+    the others are drawn uniformly over the image.
+
+    patch_size: int or (height, width) of the patches
+    foreground_fraction: fraction of patches over the foreground
+    """
+
+    def __init__(self, patch_size, foreground_fraction=0.5):
+        self.patch_size = (patch_size, patch_size) if isinstance(patch_size, int) else tuple(patch_size)
+        self.foreground_fraction = foreground_fraction
+
+    def __call__(self, shape, box=None):
+        """
+        shape: (height, width) of the image
+        box: relative foreground bounding box of the sample, see foreground_box
+        returns: top, left of the patch
+        """
+        h, w = shape
+        ph, pw = self.patch_size
+        if ph > h or pw > w:
+            raise ValueError("Patch size {} is larger than the image {}".format(self.patch_size, (h, w)))
+
+        if box is not None and random.random() < self.foreground_fraction:
+            center_y = random.uniform(box[0] * h, box[1] * h)
+            center_x = random.uniform(box[2] * w, box[3] * w)
+            top = int(round(center_y - ph / 2))
+            left = int(round(center_x - pw / 2))
+        else:
+            top = random.randint(0, h - ph)
+            left = random.randint(0, w - pw)
+
+        return min(max(top, 0), h - ph), min(max(left, 0), w - pw)
@@ -0,0 +1,74 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# =============================================================================
+# Read-ahead for sample files
+# Background threads read the files of the upcoming samples (e.g. on a network
+# mount) while the current ones are parsed. The contents are either kept for
+# the dataset in the same process, or only read to pull the files into the
+# page cache, where the reads of the DataLoader workers then find them.
+# =============================================================================
+
+_CHUNK_SIZE = 1 << 20
+
+
+class FileReadAhead(object):
+    """
+    max_files: maximum number of files read ahead, the oldest ones are dropped beyond
+    num_threads: number of reading threads
+    keep_data: keep the file contents for take(), otherwise they are discarded after reading
+    resolve: maps a path to the file that is read, e.g. utils.StagingCache.stage
+    """
+
+    def __init__(self, max_files, num_threads=4, keep_data=True, resolve=None):
+        self.max_files = max_files
+        self.num_threads = num_threads
+        self.keep_data = keep_data
+        self.resolve = resolve
+
+        self._executor = None
+        self._pending = collections.OrderedDict()
+
+    def __getstate__(self):
+        # DataLoader workers read the files themselves, from the page cache
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_pending'] = collections.OrderedDict()
+        return state
+
+    def _read(self, path):
+        if self.resolve is not None:
+            path = self.resolve(path)
+        with open(path, 'rb') as f:
+            if self.keep_data:
+                return f.read()
+            while f.read(_CHUNK_SIZE):
+                pass
+        return None
+
+    def schedule(self, paths):
+        """Starts reading the files in the background"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+
+        for path in paths:
+            if path in self._pending:
+                continue
+            self._pending[path] = self._executor.submit(self._read, path)
+            while len(self._pending) > self.max_files:
+                self._pending.popitem(last=False)
+
+        if not self.keep_data:
+            for path in [p for p, future in self._pending.items() if future.done()]:
+                del self._pending[path]
+
+    def take(self, path):
+        """Contents of a file read ahead, waiting for a running read. None if it was not scheduled or failed."""
+        future = self._pending.pop(path, None)
+        if future is None or not self.keep_data:
+            return None
+        try:
+            return future.result()
+        except OSError:
+            # the regular read reports the error
+            return None
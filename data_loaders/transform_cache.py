@@ -0,0 +1,101 @@
+import hashlib
+import os
+
+import torch
+from torchvision import transforms
+
+from utils import ensure_dir
+
+# =============================================================================
+# Cache for the deterministic prefix of a transform pipeline
+# Transforms declare themselves with a 'deterministic' attribute. The leading
+# deterministic transforms of a Compose (e.g. Rescale, ToTensor for val/test)
+# are applied once per sample, the result is kept in memory or on disk, and
+# only the remaining transforms run every epoch.
+# =============================================================================
+
+
+def split_deterministic_prefix(transform):
+    """
+    Splits a transform (a single transform or a transforms.Compose) into the
+    list of its leading deterministic transforms and the list of the rest.
+    """
+    transform_list = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+
+    n_prefix = 0
+    for t in transform_list:
+        if not getattr(t, 'deterministic', False):
+            break
+        n_prefix += 1
+
+    return transform_list[:n_prefix], transform_list[n_prefix:]
+
+
+class CachedTransform(object):
+    """
+    Applies a transform and caches the output of its deterministic prefix per sample.
+
+    transform: the transform pipeline
+    cache_dir: folder to keep the cached samples in, kept in memory if None.
+               The cached samples go into a sub folder keyed by the transform
+               parameters, so pipelines with different parameters never mix.
+    """
+
+    def __init__(self, transform, cache_dir=None):
+        prefix, rest = split_deterministic_prefix(transform)
+        self.prefix = transforms.Compose(prefix)
+        self.rest = transforms.Compose(rest)
+
+        # the repr of the deterministic transforms contains all their parameters
+        self.key = hashlib.sha1(repr(self.prefix).encode('utf-8')).hexdigest()
+
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir, self.key)
+            ensure_dir(self.cache_dir)
+        self._memory = {}
+
+    @property
+    def enabled(self):
+        return len(self.prefix.transforms) > 0
+
+    @property
+    def in_memory(self):
+        return self.cache_dir is None
+
+    def _path(self, sample_id):
+        return os.path.join(self.cache_dir, hashlib.sha1(sample_id.encode('utf-8')).hexdigest() + '.pt')
+
+    def _get(self, sample_id):
+        if self.in_memory:
+            return self._memory.get(sample_id)
+
+        path = self._path(sample_id)
+        if os.path.isfile(path):
+            return torch.load(path)
+        return None
+
+    def _put(self, sample_id, sample):
+        # the dataset casts to float anyway, float32 halves the cache size
+        sample = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v
+                  for k, v in sample.items()}
+
+        if self.in_memory:
+            self._memory[sample_id] = sample
+        else:
+            # several DataLoader workers may write the same cache, so write and rename
+            path = self._path(sample_id)
+            tmp_path = path + '.tmp{}'.format(os.getpid())
+            torch.save(sample, tmp_path)
+            os.replace(tmp_path, path)
+        return sample
+
+    def __call__(self, sample_id, load_sample):
+        """
+        sample_id: unique string id of the sample, e.g. its file path
+        load_sample: function that loads the untransformed sample
+        """
+        sample = self._get(sample_id)
+        if sample is None:
+            sample = self._put(sample_id, self.prefix(load_sample()))
+        return self.rest(dict(sample))
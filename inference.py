@@ -0,0 +1,57 @@
+import json
+
+import numpy as np
+import torch
+
+"""
+    Standalone loader of the inference artifacts of utils/export_model.py.
+    Needs torch and numpy only, neither the model classes nor the training stack:
+
+        model = load_inference_model('quicknat.pt', device='cuda')
+        prediction = model.predict(images)  # [BATCH_SIZE x C x H x W] array or tensor
+"""
+
+# name of the metadata file in the artifact, see model/export.py
+_EXPORT_METADATA = 'export.json'
+
+
+class InferenceModel(object):
+    """
+    An exported model on a device.
+
+    metadata: export settings, e.g. 'arch', 'mode', 'mc_samples' and 'input_shape'.
+              With mc_samples > 0 every call returns [BATCH_SIZE x SAMPLES x ...].
+    """
+
+    def __init__(self, module, metadata, device):
+        self.module = module
+        self.metadata = metadata
+        self.device = device
+        self.mc_samples = metadata.get('mc_samples', 0)
+
+    def __call__(self, data):
+        """Raw output of the model for a [BATCH_SIZE x C x H x W] array or tensor"""
+        if isinstance(data, np.ndarray):
+            data = torch.from_numpy(data)
+        data = data.to(self.device, torch.float32, non_blocking=True)
+        with torch.no_grad():
+            return self.module(data)
+
+    def predict(self, data):
+        """Class index per image or pixel, of the mean over the samples for MC artifacts"""
+        out = self(data)
+        # e.g. segmentation and classification of QuickFCN
+        if isinstance(out, tuple):
+            out = out[0]
+        if self.mc_samples > 0:
+            out = out.mean(dim=1)
+        return out.argmax(dim=1).cpu().numpy()
+
+
+def load_inference_model(path, device='cpu'):
+    """Loads an artifact of utils/export_model.py to the device"""
+    device = torch.device(device)
+    extra_files = {_EXPORT_METADATA: ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files[_EXPORT_METADATA] or '{}')
+    return InferenceModel(module, metadata, device)
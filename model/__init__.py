@@ -9,3 +9,4 @@ from .quickfcn import *
 from .quickfcn_classifier import *
 from .softquickfcn import *
 from .custom_quicknat import *
+from .export import *
@@ -161,9 +161,26 @@ class EncoderBlock(DenseBlock):
         :rtype: torch.tensor [FloatTensor], torch.tensor [FloatTensor], torch.tensor [LongTensor]
         """
 
+        return self.forward_sampled(self.forward_prefix(input, weights))
+
+    def forward_prefix(self, input, weights=None):
+        """Deterministic part of the forward pass, up to the dropout
+
+        :return: output tensor of the dense and SE block
+        :rtype: torch.tensor [FloatTensor]
+        """
+
         out_block = super(EncoderBlock, self).forward(input)
         if self.SELayer:
             out_block = self.SELayer(out_block, weights)
+        return out_block
+
+    def forward_sampled(self, out_block):
+        """Stochastic part of the forward pass, from the output of forward_prefix
+
+        :return: output tensor with maxpool, output tensor without maxpool, indices for unpooling
+        :rtype: torch.tensor [FloatTensor], torch.tensor [FloatTensor], torch.tensor [LongTensor]
+        """
 
         if self.drop_out_needed:
             out_block = self.drop_out(out_block)
@@ -265,7 +282,27 @@ class CustomQuickNat(BaseModel):
         :param input: X
         :return: probabiliy map
         """
-        e1, out1, ind1 = self.encode1.forward(input)
+        return self.forward_sampled(self.forward_prefix(input))
+
+    def forward_prefix(self, input):
+        """
+        Deterministic start of the forward pass: encode1 up to its dropout. It is the
+        same for all MC-dropout samples, which share it and only run forward_sampled
+        (see utils.MCSampler).
+
+        :param input: X
+        :return: encode1 activation before the dropout
+        """
+        return self.encode1.forward_prefix(input)
+
+    def forward_sampled(self, prefix):
+        """
+        Stochastic rest of the forward pass, from the output of forward_prefix
+
+        :param prefix: encode1 activation before the dropout
+        :return: probabiliy map
+        """
+        e1, out1, ind1 = self.encode1.forward_sampled(prefix)
         e2, out2, ind2 = self.encode2.forward(e1)
         e3, out3, ind3 = self.encode3.forward(e2)
         e4, out4, ind4 = self.encode4.forward(e3)
@@ -0,0 +1,162 @@
+import copy
+import json
+
+import torch
+import torch.nn as nn
+from torch.nn.modules.utils import _pair
+
+# =============================================================================
+# Inference export
+# A trained model is traced (or scripted) into a self-contained TorchScript
+# artifact and frozen, so its weights become constants of the graph. The
+# artifact runs through inference.py with torch only, without the model
+# classes or the training stack.
+# With mc_samples, the dropout layers stay active and every call returns
+# mc_samples MC-dropout samples of one folded pass, [BATCH_SIZE x SAMPLES x ...].
+# ProbabilisticQuickNat draws its samples from the prior latent space instead.
+# =============================================================================
+
+# name of the metadata file in the artifact, read by inference.py
+EXPORT_METADATA = 'export.json'
+
+
+def enable_dropout(model):
+    """Puts all dropout layers of the model in training mode, the other layers are left as they are"""
+    for module in model.modules():
+        if isinstance(module, nn.modules.dropout._DropoutNd):
+            module.train()
+
+
+class TraceableMaxUnpool2d(nn.Module):
+    """
+    MaxUnpool2d for tracing. F.max_unpool2d checks its default output size in Python,
+    which fails on the traced sizes of newer torch versions. This computes the default
+    size (e.g. twice the input for the 2x2 pooling of QuickNat) and calls the ATen
+    operator directly, so the traced graph keeps the size dynamic.
+    """
+
+    def __init__(self, unpool):
+        super(TraceableMaxUnpool2d, self).__init__()
+        self.kernel_size = _pair(unpool.kernel_size)
+        self.stride = _pair(unpool.stride if unpool.stride is not None else unpool.kernel_size)
+        self.padding = _pair(unpool.padding)
+
+    def forward(self, input, indices, output_size=None):
+        if output_size is None:
+            output_size = [(input.shape[d + 2] - 1) * self.stride[d] - 2 * self.padding[d] + self.kernel_size[d]
+                           for d in range(2)]
+        return torch._C._nn.max_unpool2d(input, indices, list(output_size)[-2:])
+
+
+def make_traceable(model):
+    """Replaces the MaxUnpool2d layers of the model (e.g. of the DecoderBlocks) with TraceableMaxUnpool2d"""
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.MaxUnpool2d):
+                setattr(module, name, TraceableMaxUnpool2d(child))
+    return model
+
+
+class MCDropoutInference(nn.Module):
+    """
+    num_samples MC-dropout samples of a model in one forward pass, folded into
+    the batch dimension. Models with forward_prefix (e.g. QuickNat) run their
+    deterministic prefix once.
+    """
+
+    def __init__(self, model, num_samples):
+        super(MCDropoutInference, self).__init__()
+        self.model = model
+        self.num_samples = num_samples
+
+    def _unfold(self, out, batch_size):
+        # [SAMPLES * BATCH_SIZE x ...] -> [BATCH_SIZE x SAMPLES x ...]
+        return out.view(self.num_samples, batch_size, *out.shape[1:]).transpose(0, 1)
+
+    def forward(self, input):
+        batch_size = input.shape[0]
+        forward = self.model
+        if hasattr(self.model, 'forward_prefix'):
+            input, forward = self.model.forward_prefix(input), self.model.forward_sampled
+
+        out = forward(input.repeat(self.num_samples, *([1] * (input.dim() - 1))))
+        if isinstance(out, tuple):
+            return tuple(self._unfold(o, batch_size) for o in out)
+        return self._unfold(out, batch_size)
+
+
+class ProbabilisticInference(nn.Module):
+    """
+    Segmentations of ProbabilisticQuickNat from its prior latent space: the
+    decoded prior mean, or num_samples prior samples [BATCH_SIZE x SAMPLES x ...]
+    """
+
+    def __init__(self, model, num_samples=0):
+        super(ProbabilisticInference, self).__init__()
+        self.model = model
+        self.num_samples = num_samples
+
+    def forward(self, input):
+        features = self.model.quicknat(input)
+        prior = self.model.prior(input).base_dist
+        if self.num_samples == 0:
+            return self.model.fcomb(features, prior.loc)
+
+        # reparameterized samples, randn_like follows the device the artifact is loaded to
+        loc = prior.loc.expand(self.num_samples, *prior.loc.shape)
+        z = loc + prior.scale * torch.randn_like(loc)
+        return self.model.fcomb.forward_k(features, z)
+
+
+def inference_module(model, mc_samples=0):
+    """The module that is exported for the model, in inference mode"""
+    model.eval()
+    if type(model).__name__ == 'ProbabilisticQuickNat':
+        return ProbabilisticInference(model, mc_samples).eval()
+    if mc_samples > 0:
+        module = MCDropoutInference(model, mc_samples).eval()
+        enable_dropout(module)
+        return module
+    return model
+
+
+def export_model(model, example_input, path, mode='trace', mc_samples=0, metadata=None):
+    """
+    Exports a model as a frozen TorchScript inference artifact.
+
+    model: the trained model
+    example_input: [BATCH_SIZE x C x H x W] input the model is traced with
+    path: file the artifact is written to
+    mode: 'trace' or 'script'. Traced graphs keep the control flow taken for example_input
+          (e.g. the pooling of QuickFCN for other resolutions than the example's).
+    mc_samples: number of MC samples per call, 0 for a deterministic artifact
+    metadata: dict stored in the artifact next to the export settings
+    """
+    # the exported copy gets its own layer modes and unpooling, the model is left as it is
+    model = copy.deepcopy(model)
+    if mode == 'trace':
+        make_traceable(model)
+    module = inference_module(model, mc_samples)
+
+    with torch.no_grad():
+        if mode == 'trace':
+            # MC samples differ between the check runs of the tracer
+            exported = torch.jit.trace(module, example_input, check_trace=mc_samples == 0)
+        elif mode == 'script':
+            exported = torch.jit.script(module)
+        else:
+            raise ValueError("Unknown export mode '{}', use 'trace' or 'script'".format(mode))
+
+    if hasattr(torch.jit, 'freeze'):
+        exported = torch.jit.freeze(exported.eval())
+    else:
+        print("torch.jit.freeze is not available in torch {}, the artifact is not frozen".format(torch.__version__))
+
+    metadata = dict(metadata or {})
+    metadata.update({'mode': mode,
+                     'mc_samples': mc_samples,
+                     'input_shape': list(example_input.shape)})
+    torch.jit.save(exported, path, _extra_files={EXPORT_METADATA: json.dumps(metadata)})
+    print("Exported {} ({}, mc_samples={}) to {}".format(metadata.get('arch', type(model).__name__), mode,
+                                                         mc_samples, path))
+    return exported
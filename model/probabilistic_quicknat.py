@@ -131,7 +131,8 @@ class Fcomb(BaseModel):
     and output of the quicknat (the feature map) by concatenating them along their channel axis.
     """
 
-    def __init__(self, num_filters, latent_dim, num_output_channels, num_classes, no_convs_fcomb, initializers, use_tile=True):
+    def __init__(self, num_filters, latent_dim, num_output_channels, num_classes, no_convs_fcomb, initializers, use_tile=True,
+                 latent_bias=False):
         super(Fcomb, self).__init__()
         self.num_channels = num_output_channels  # output channels
         self.num_classes = num_classes
@@ -141,6 +142,8 @@ class Fcomb(BaseModel):
         self.latent_dim = latent_dim
         self.use_tile = use_tile
         self.no_convs_fcomb = no_convs_fcomb
+        # the latent part of the first 1x1 convolution as a per-sample bias, see _first_layer
+        self.latent_bias = latent_bias
         self.name = 'Fcomb'
 
         if self.use_tile:
@@ -187,16 +190,55 @@ class Fcomb(BaseModel):
         So broadcast Z to batch_sizexlatent_dimxHxW. Behavior is exactly the same as tf.tile (verified)
         """
         if self.use_tile:
-            z = torch.unsqueeze(z, 2)
-            z = self.tile(z, 2, feature_map.shape[self.spatial_axes[0]])
-            z = torch.unsqueeze(z, 3)
-            z = self.tile(z, 3, feature_map.shape[self.spatial_axes[1]])
+            if getattr(self, 'latent_bias', False):
+                output = self.layers[2:](self._first_layer(feature_map, z))
+                return self.last_layer(output)
+
+            # a broadcast view of z, the concatenation below is its only copy
+            z = z[:, :, None, None].expand(-1, -1, *feature_map.shape[2:])
 
             # Concatenate the feature map (output of the quicknat) and the sample taken from the latent space
             feature_map = torch.cat((feature_map, z), dim=self.channel_axis)
             output = self.layers(feature_map)
             return self.last_layer(output)
 
+    def _first_layer(self, feature_map, z):
+        """
+        First 1x1 convolution and ReLU of the concatenation of the feature map and the tiled z,
+        without building it: the convolution splits into one over the features and a per-sample
+        bias W_z * z.
+        feature_map: batch_sizexno_channelsxHxW
+        z: ...xbatch_sizexlatent_dim
+        returns: ...xbatch_sizexnum_filtersxHxW
+        """
+        conv = self.layers[0]
+        num_features = feature_map.shape[self.channel_axis]
+        weight = conv.weight[:, :, 0, 0]
+        features = F.conv2d(feature_map, conv.weight[:, :num_features], conv.bias)
+        bias = torch.matmul(z, weight[:, num_features:].t())
+        return F.relu(features + bias[..., None, None])
+
+    def forward_k(self, feature_map, z):
+        """
+        Decodes k latent samples per image in one batched pass.
+        feature_map: batch_sizexno_channelsxHxW
+        z: kxbatch_sizexlatent_dim
+        returns: batch_sizexkxnum_classesxHxW
+        """
+        k, batch_size = z.shape[:2]
+        if getattr(self, 'latent_bias', False):
+            # the features pass the first layer once, the k samples differ by their bias only
+            output = self._first_layer(feature_map, z)
+            output = self.layers[2:](output.view(k * batch_size, *output.shape[2:]))
+            output = self.last_layer(output)
+            return output.view(k, batch_size, *output.shape[1:]).transpose(0, 1)
+
+        # [k * batch_size x ...], the k samples of every image share its feature map
+        feature_map = feature_map.unsqueeze(0).expand(k, *feature_map.shape).reshape(k * batch_size,
+                                                                                     *feature_map.shape[1:])
+        output = self.forward(feature_map, z.reshape(k * batch_size, -1))
+        return output.view(k, batch_size, *output.shape[1:]).transpose(0, 1)
+
 
 class ProbabilisticQuickNat(BaseModel):
     """
@@ -226,6 +268,7 @@ class ProbabilisticQuickNat(BaseModel):
                        'latent_dim': 6,
                        'no_convs_per_block': 3,
                        'no_convs_fcomb': 4,
+                       'fcomb_latent_bias': True,
                        'beta': 10.0}
 
         for key, val in params.items():
@@ -264,7 +307,8 @@ class ProbabilisticQuickNat(BaseModel):
                            self.params["num_class"],
                            self.params['no_convs_fcomb'],
                            {'w': 'orthogonal', 'b': 'normal'},
-                           use_tile=True).to(device)
+                           use_tile=True,
+                           latent_bias=self.params['fcomb_latent_bias']).to(device)
 
     def forward(self, patch, segm, training=True):
         """
@@ -296,6 +340,19 @@ class ProbabilisticQuickNat(BaseModel):
             self.z_prior_sample = z_prior
         return self.fcomb.forward(self.quicknat_features, z_prior)
 
+    def sample_k(self, k, testing=False):
+        """
+        Sample k segmentations per image from the prior latent space of the last forward
+        pass, decoded in one batched pass over the cached quicknat features, e.g. for the GED.
+        Returns batch_sizexkxnum_classesxHxW, z_prior_sample holds the kxbatch_sizexlatent_dim latents.
+        """
+        if testing == False:
+            z_prior = self.prior_latent_space.rsample((k,))
+        else:
+            z_prior = self.prior_latent_space.sample((k,))
+        self.z_prior_sample = z_prior
+        return self.fcomb.forward_k(self.quicknat_features, z_prior)
+
     def reconstruct(self, use_posterior_mean=False, calculate_posterior=False, z_posterior=None):
         """
         Reconstruct a segmentation from a posterior sample (decoding a posterior sample) and quicknat feature map
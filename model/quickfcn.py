@@ -2,10 +2,15 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from nn_common_modules import modules as sm
 from squeeze_and_excitation import squeeze_and_excitation as se
 from base import BaseModel
 
+# spatial size of the bottleneck for 400 x 400 inputs, which the classification head is sized for
+_CLASSIFIER_GRID = (25, 25)
+
+
 class QuickFCN(BaseModel):
     """
     A PyTorch implementation of QuickNAT
@@ -55,7 +60,31 @@ class QuickFCN(BaseModel):
         :param input: X
         :return: probabiliy map
         """
-        e1, out1, ind1 = self.encode1.forward(input)
+        return self.forward_sampled(self.forward_prefix(input))
+
+    def forward_prefix(self, input):
+        """
+        Deterministic start of the forward pass: encode1 up to its dropout. It is the
+        same for all MC-dropout samples, which share it and only run forward_sampled
+        (see utils.MCSampler).
+
+        :param input: X
+        :return: encode1 activation before the dropout
+        """
+        out_block = sm.DenseBlock.forward(self.encode1, input)
+        if self.encode1.SELayer:
+            out_block = self.encode1.SELayer(out_block)
+        return out_block
+
+    def forward_sampled(self, prefix):
+        """
+        Stochastic rest of the forward pass, from the output of forward_prefix
+
+        :param prefix: encode1 activation before the dropout
+        :return: probabiliy map, classes
+        """
+        out1 = self.encode1.drop_out(prefix) if self.encode1.drop_out_needed else prefix
+        e1, ind1 = self.encode1.maxpool(out1)
         e2, out2, ind2 = self.encode2.forward(e1)
         e3, out3, ind3 = self.encode3.forward(e2)
         e4, out4, ind4 = self.encode4.forward(e3)
@@ -70,6 +99,9 @@ class QuickFCN(BaseModel):
         prob = self.segmenter.forward(d1)
 
         ############Classification Task############
+        # other resolutions, e.g. from a resolution schedule, are pooled to the grid of the classifier
+        if bn.shape[2:] != _CLASSIFIER_GRID:
+            bn = F.adaptive_avg_pool2d(bn, _CLASSIFIER_GRID)
         bn_flattened = bn.view(bn.shape[0],-1) #reshape to (Batch Size, Input Dim Flattened)
         classes = self.classifier.forward(bn_flattened)
 
@@ -2,11 +2,16 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from nn_common_modules import modules as sm
 from squeeze_and_excitation import squeeze_and_excitation as se
 from base import BaseModel
 from model import ResUltNet
 
+# spatial size of the bottleneck for 400 x 400 inputs, which the classification head is sized for
+_CLASSIFIER_GRID = (25, 25)
+
+
 class QuickFCNClassifier(BaseModel):
     """
     A PyTorch implementation of QuickNAT
@@ -55,6 +60,9 @@ class QuickFCNClassifier(BaseModel):
         bn = self.bottleneck.forward(e4)
 
         ############Classification Task############
+        # other resolutions, e.g. from a resolution schedule, are pooled to the grid of the classifier
+        if bn.shape[2:] != _CLASSIFIER_GRID:
+            bn = F.adaptive_avg_pool2d(bn, _CLASSIFIER_GRID)
         bn_flattened = bn.view(bn.shape[0],-1) #reshape to (Batch Size, Input Dim Flattened)
         classes = self.classifier.forward(bn_flattened)
 
@@ -48,7 +48,31 @@ class QuickNat(BaseModel):
         :param input: X
         :return: probabiliy map
         """
-        e1, out1, ind1 = self.encode1.forward(input)
+        return self.forward_sampled(self.forward_prefix(input))
+
+    def forward_prefix(self, input):
+        """
+        Deterministic start of the forward pass: encode1 up to its dropout. It is the
+        same for all MC-dropout samples, which share it and only run forward_sampled
+        (see utils.MCSampler).
+
+        :param input: X
+        :return: encode1 activation before the dropout
+        """
+        out_block = sm.DenseBlock.forward(self.encode1, input)
+        if self.encode1.SELayer:
+            out_block = self.encode1.SELayer(out_block)
+        return out_block
+
+    def forward_sampled(self, prefix):
+        """
+        Stochastic rest of the forward pass, from the output of forward_prefix
+
+        :param prefix: encode1 activation before the dropout
+        :return: probabiliy map
+        """
+        out1 = self.encode1.drop_out(prefix) if self.encode1.drop_out_needed else prefix
+        e1, ind1 = self.encode1.maxpool(out1)
         e2, out2, ind2 = self.encode2.forward(e1)
         e3, out3, ind3 = self.encode3.forward(e2)
         e4, out4, ind4 = self.encode4.forward(e3)
@@ -2,10 +2,15 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from nn_common_modules import modules as sm
 from squeeze_and_excitation import squeeze_and_excitation as se
 from base import BaseModel
 
+# spatial size of the bottleneck for 400 x 400 inputs, which the classification head is sized for
+_CLASSIFIER_GRID = (50, 50)
+
+
 class GroupNorm(nn.Module):
     def __init__(self, num_features, num_groups=32, eps=1e-5):
         super(GroupNorm, self).__init__()
@@ -332,6 +337,9 @@ class SoftQuickFCN(BaseModel):
         prob = self.classifier_seg.forward(d1)
 
         ############Classification Task############
+        # other resolutions, e.g. from a resolution schedule, are pooled to the grid of the classifier
+        if bnc_sum.shape[2:] != _CLASSIFIER_GRID:
+            bnc_sum = F.adaptive_avg_pool2d(bnc_sum, _CLASSIFIER_GRID)
         bn_flattened = bnc_sum.view(bnc_sum.shape[0],-1) #reshape to (Batch Size, Input Dim Flattened)
         classes = self.classifier_class.forward(bn_flattened)
 
@@ -20,7 +20,7 @@ import model.loss as module_loss
 import model.metric as module_metric
 from base import BaseRunner, CustomArgs
 from parse_config import ConfigParser
-from utils import build_segmentation_grid, save_grid, util
+from utils import MCSampler, build_segmentation_grid, save_grid, util
 
 
 
@@ -53,6 +53,7 @@ class OpusTester(BaseRunner):
         experiment.set_name("Test")
 
         self.metrics_sample_count = config['trainer']['mc_sample_count']['val_test']
+        mc_sampler = MCSampler.from_config(config['trainer'])
         # setup data_loader instances
         data_loader = getattr(module_data, config['data_loader']['type'])(
             config['data_loader']['args']['data_dir'],
@@ -96,7 +97,7 @@ class OpusTester(BaseRunner):
             for i, (data, target, idx) in enumerate(tqdm(data_loader)):
                 data, target = data.to(self.device), target.to(self.device)
                 output, samples = util.sample_and_compute_mean(
-                    model, data, self.metrics_sample_count, 2, self.device)
+                    model, data, self.metrics_sample_count, 2, self.device, sampler=mc_sampler)
 
                 # computing loss, metrics on test set
                 loss = loss_fn(output, target)
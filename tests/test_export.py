@@ -0,0 +1,110 @@
+import copy
+import os
+import sys
+
+import pytest
+import torch
+
+# This is important to be able to call other modules
+# in the upper directory (root dir for our code)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('nn_common_modules')
+pytest.importorskip('squeeze_and_excitation')
+pytest.importorskip('polyaxon_client')
+
+import model as module_arch
+from inference import load_inference_model
+
+"""
+    Exports models of the QuickNat family in-tree, reloads them with the
+    standalone loader and compares the outputs with the eager models.
+"""
+
+PARAMS = {'num_channels': 7,
+          'num_filters': 64,
+          'kernel_h': 5,
+          'kernel_w': 5,
+          'kernel_c': 1,
+          'stride_conv': 1,
+          'pool': 2,
+          'stride_pool': 2,
+          'num_class': 2,
+          'se_block': 'CSSE',
+          'drop_out': 0.2}
+
+
+def _export_and_load(model, example_input, tmp_path, mc_samples=0):
+    path = str(tmp_path / 'model_{}.pt'.format(mc_samples))
+    module_arch.export_model(model, example_input, path, mc_samples=mc_samples, metadata={'arch': 'test'})
+    return load_inference_model(path)
+
+
+def _quicknat():
+    torch.manual_seed(0)
+    return module_arch.QuickNat(dict(PARAMS)).eval()
+
+
+def _probabilistic_quicknat():
+    torch.manual_seed(0)
+    return module_arch.ProbabilisticQuickNat(dict(PARAMS, num_channels=1)).to('cpu').eval()
+
+
+def test_quicknat_matches_eager(tmp_path):
+    model = _quicknat()
+    data = torch.randn(2, 7, 32, 32)
+    exported = _export_and_load(model, data, tmp_path)
+
+    with torch.no_grad():
+        assert torch.allclose(exported(data), model(data), atol=1e-5)
+        # the traced unpooling keeps the resolution dynamic
+        other_size = torch.randn(1, 7, 48, 48)
+        assert torch.allclose(exported(other_size), model(other_size), atol=1e-5)
+    assert exported.metadata['mc_samples'] == 0
+
+
+def test_quicknat_mc_dropout_matches_eager(tmp_path):
+    model = _quicknat()
+    data = torch.randn(2, 7, 32, 32)
+    exported = _export_and_load(model, data, tmp_path, mc_samples=3)
+    # the export works on a copy
+    assert not model.encode1.drop_out.training
+
+    eager = module_arch.inference_module(copy.deepcopy(model), mc_samples=3)
+    torch.manual_seed(1)
+    samples = exported(data)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        eager_samples = eager(data)
+
+    assert samples.shape == (2, 3, 2, 32, 32)
+    assert torch.allclose(samples, eager_samples, atol=1e-5)
+    assert (samples[:, 0] - samples[:, 1]).abs().max() > 0
+    assert exported.predict(data).shape == (2, 32, 32)
+
+
+def test_probabilistic_quicknat_matches_eager(tmp_path):
+    model = _probabilistic_quicknat()
+    data = torch.randn(2, 1, 32, 32)
+    exported = _export_and_load(model, data, tmp_path)
+
+    with torch.no_grad():
+        prior_mean = model.prior(data).base_dist.loc
+        expected = model.fcomb(model.quicknat(data), prior_mean)
+    assert torch.allclose(exported(data), expected, atol=1e-5)
+
+
+def test_probabilistic_quicknat_samples_match_eager(tmp_path):
+    model = _probabilistic_quicknat()
+    data = torch.randn(2, 1, 32, 32)
+    exported = _export_and_load(model, data, tmp_path, mc_samples=4)
+
+    eager = module_arch.inference_module(copy.deepcopy(model), mc_samples=4)
+    torch.manual_seed(1)
+    samples = exported(data)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        eager_samples = eager(data)
+
+    assert samples.shape == (2, 4, 2, 32, 32)
+    assert torch.allclose(samples, eager_samples, atol=1e-5)
@@ -2,18 +2,23 @@ import numpy as np
 import torch
 from torchvision.utils import make_grid
 from base import BaseTrainer
-from utils import inf_loop, MetricTracker, binary, impose_labels_on_image
+from utils import inf_loop, MetricTracker, binary, impose_labels_on_image, per_sample_loss
 
 
 class OPUSMultitaskTrainer(BaseTrainer):
     """
     Trainer class
     """
+    supports_selective_backprop = True
     def __init__(self, model, criterion, metric_ftns, optimizer, config, data_loader,
                  valid_data_loader=None, lr_scheduler=None, len_epoch=None, experiment=None):
         super().__init__(model, criterion, metric_ftns, optimizer, config, experiment)
         self.config = config
+        data_loader = self._prefetch(data_loader)
+        valid_data_loader = self._prefetch(valid_data_loader)
         self.data_loader = data_loader
+        # post-collate augmentation applied on the device, if the data loader has one
+        self.batch_transform = getattr(data_loader, 'batch_transform', None)
         if len_epoch is None:
             # epoch-based training
             self.len_epoch = len(self.data_loader)
@@ -68,8 +73,21 @@ class OPUSMultitaskTrainer(BaseTrainer):
         """
         self.model.train()
         self.train_metrics.reset()
-        for batch_idx, (data, target_seg, target_class) in enumerate(self.data_loader):
+        for batch_idx, (data, target_seg, target_class, *idx) in enumerate(self.data_loader):
             data, target_seg, target_class = data.to(self.device), target_seg.to(self.device), target_class.to(self.device)
+            if self.batch_transform is not None:
+                data, target_seg = self.batch_transform(data, target_seg)
+
+            # the dataset indices are in the batch with with_idx
+            sampler = self._importance_sampler() if idx else None
+            if sampler is not None and self.selective_backprop_threshold is not None:
+                # score the batch without gradients, then train on the hard samples only
+                with torch.no_grad():
+                    sample_losses = per_sample_loss(self.criterion, self._score_batch(data), target_seg, target_class,
+                                                    epoch)
+                sampler.update(idx[0], sample_losses)
+                keep = self._select_samples(sample_losses)
+                data, target_seg, target_class = data[keep], target_seg[keep], target_class[keep]
 
             self.optimizer.zero_grad()
             output_seg, output_class = self.model(data)
@@ -77,6 +95,10 @@ class OPUSMultitaskTrainer(BaseTrainer):
             loss.backward()
             self.optimizer.step()
 
+            if sampler is not None and self.selective_backprop_threshold is None:
+                sampler.update(idx[0], per_sample_loss(self.criterion, (output_seg, output_class),
+                                                       target_seg, target_class, epoch))
+
             self.writer.set_step((epoch - 1) * self.len_epoch + batch_idx)
             self.train_metrics.update('loss', loss.item())
             for met in self.metric_ftns:
@@ -116,7 +138,7 @@ class OPUSMultitaskTrainer(BaseTrainer):
         self.model.eval()
         self.valid_metrics.reset()
         with torch.no_grad():
-            for batch_idx, (data, target_seg, target_class) in enumerate(self.valid_data_loader):
+            for batch_idx, (data, target_seg, target_class, *_) in enumerate(self.valid_data_loader):
                 data, target_seg, target_class = data.to(self.device), target_seg.to(self.device), target_class.to(self.device)
 
                 output_seg, output_class = self.model(data)
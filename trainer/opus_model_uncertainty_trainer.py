@@ -11,6 +11,7 @@ class OPUSWithUncertaityTrainer(Trainer):
     """
     Trainer class
     """
+    supports_selective_backprop = True
 
     def __init__(self, model, criterion, metric_ftns, optimizer, config, data_loader,
                  valid_data_loader=None, lr_scheduler=None, len_epoch=None, experiment=None):
@@ -31,17 +32,32 @@ class OPUSWithUncertaityTrainer(Trainer):
 
         self.model.train()
         self.train_metrics.reset()
-        for batch_idx, (data, target, _, _) in enumerate(self.data_loader):
+        for batch_idx, (data, target, _, idx) in enumerate(self.data_loader):
             data, target = data.to(self.device), target.to(self.device)
+            if self.batch_transform is not None:
+                data, target = self.batch_transform(data, target)
+
+            sampler = self._importance_sampler()
+            if sampler is not None and self.selective_backprop_threshold is not None:
+                # score the batch with one deterministic pass, then train on the hard samples only
+                with torch.no_grad():
+                    sample_losses = util.per_sample_loss(self.criterion, self._score_batch(data), target)
+                sampler.update(idx, sample_losses)
+                keep = self._select_samples(sample_losses)
+                data, target = data[keep], target[keep]
 
             self.optimizer.zero_grad()
 
-            output, _ = util.sample_and_compute_mean(self.model, data, self.train_mc_sample_count, 2, self.device)
+            output, _ = util.sample_and_compute_mean(self.model, data, self.train_mc_sample_count, 2, self.device,
+                                                     sampler=self.mc_sampler, keep_samples=False)
 
             loss = self.criterion(output, target)
             loss.backward()
             self.optimizer.step()
 
+            if sampler is not None and self.selective_backprop_threshold is None:
+                sampler.update(idx, util.per_sample_loss(self.criterion, output, target))
+
             # self.writer.set_step((epoch - 1) * self.len_epoch + batch_idx)
             self.train_metrics.update('loss', loss.item())
             for met in self.metric_ftns:
@@ -84,7 +100,8 @@ class OPUSWithUncertaityTrainer(Trainer):
             for batch_idx, (data, target, _, idxs) in enumerate(self.valid_data_loader):
                 data, target = data.to(self.device), target.to(self.device)
 
-                output, samples = util.sample_and_compute_mean(self.model, data, self.val_mc_sample_count, 2, self.device)
+                output, samples = util.sample_and_compute_mean(self.model, data, self.val_mc_sample_count, 2, self.device,
+                                                               sampler=self.mc_sampler)
 
                 loss = self.criterion(output, target)
 
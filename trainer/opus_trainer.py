@@ -13,7 +13,11 @@ class OPUSTrainer(BaseTrainer):
                  valid_data_loader=None, lr_scheduler=None, len_epoch=None, experiment=None):
         super().__init__(model, criterion, metric_ftns, optimizer, config, experiment)
         self.config = config
+        data_loader = self._prefetch(data_loader)
+        valid_data_loader = self._prefetch(valid_data_loader)
         self.data_loader = data_loader
+        # post-collate augmentation applied on the device, if the data loader has one
+        self.batch_transform = getattr(data_loader, 'batch_transform', None)
         if len_epoch is None:
             # epoch-based training
             self.len_epoch = len(self.data_loader)
@@ -40,6 +44,8 @@ class OPUSTrainer(BaseTrainer):
         self.train_metrics.reset()
         for batch_idx, (data, target_seg) in enumerate(self.data_loader):
             data, target = data.to(self.device), target.to(self.device)
+            if self.batch_transform is not None:
+                data, target = self.batch_transform(data, target)
 
             self.optimizer.zero_grad()
             output = self.model(data)
@@ -15,6 +15,8 @@ class ProbabilisticTrainer(BaseTrainer):
                  valid_data_loader=None, lr_scheduler=None, len_epoch=None, experiment=None):
         super().__init__(model, criterion, metric_ftns, optimizer, config, experiment)
         self.config = config
+        data_loader = self._prefetch(data_loader)
+        valid_data_loader = self._prefetch(valid_data_loader)
         self.data_loader = data_loader
         if len_epoch is None:
             # epoch-based training
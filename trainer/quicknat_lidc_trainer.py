@@ -13,6 +13,8 @@ class QuicknatLIDCTrainer(BaseTrainer):
                  valid_data_loader=None, lr_scheduler=None, len_epoch=None, experiment=None):
         super().__init__(model, criterion, metric_ftns, optimizer, config, experiment)
         self.config = config
+        data_loader = self._prefetch(data_loader)
+        valid_data_loader = self._prefetch(valid_data_loader)
         self.data_loader = data_loader
         if len_epoch is None:
             # epoch-based training
@@ -113,17 +115,12 @@ class QuicknatLIDCTrainer(BaseTrainer):
         return self.valid_metrics.result()
 
     def _sample(self, model, data):
-        num_samples = self.metrics_sample_count
-
-        batch_size, num_channels, image_size = data.shape[0], 1, tuple(data.shape[2:])
-        samples = torch.zeros((batch_size, num_samples, num_channels, *image_size)).to(self.device)
-        for i in range(num_samples):
-            output = model(data)
-
+        def to_label(output):
             max_val, idx = torch.max(output, 1)
-            sample = idx.unsqueeze(dim=1)
-            samples[:, i, ...] = sample
+            return idx.unsqueeze(dim=1).float()
 
+        # [BATCH_SIZE x SAMPLE_SIZE x 1 x H x W]
+        _, _, samples = self.mc_sampler(model, data, self.metrics_sample_count, output_fn=to_label)
         return samples
 
     def _progress(self, batch_idx):
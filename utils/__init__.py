@@ -1,3 +1,6 @@
+from .mc_sampling import *
 from .util import *
 from .polyaxon_utils import *
-from .visualization import *
\ No newline at end of file
+from .visualization import *
+from .shared_memory import *
+from .staging_cache import *
\ No newline at end of file
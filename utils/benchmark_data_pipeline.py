@@ -0,0 +1,250 @@
+import argparse
+import datetime
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.io
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+
+# This is important to be able to call other modules
+# in the upper directory (root dir for our code)
+sys.path.append(os.getcwd())
+
+from data_loaders import (LIDC_IDRI, MnistDataLoader, NumpyNormalize, OPUSDataset, Rescale, ToTensor,
+                          elastic_deform, label_mask)
+from utils import load_files, norm, write_json
+
+"""
+    Micro-benchmark of the data pipelines. Times every stage of the OPUS
+    pipeline (load_files, elastic_deform, Rescale, norm, ToTensor with
+    per-image or dataset normalization, NumpyNormalize, collate) and of LIDC-IDRI / MNIST, and measures the
+    samples/s of a DataLoader for several num_workers. The results are
+    written as JSON together with the git commit, so runs of different
+    commits can be compared.
+
+    Runs on real data (--opus_dir, --lidc_dir, --mnist_dir) or on
+    synthetic data generated into a temporary folder (--synthetic).
+"""
+
+_OPUS_CLASSES = ['medianus', 'ulnaris', 'radialis']
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stage(fn, inputs):
+    """
+    Applies fn to every input and returns the timing statistics in ms and the outputs
+    """
+    outputs, times = [], []
+    for x in inputs:
+        start = time.perf_counter()
+        outputs.append(fn(x))
+        times.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': float(np.mean(times)), 'std_ms': float(np.std(times)), 'n': len(times)}, outputs
+
+
+def measure_throughput(dataset, batch_size, num_workers_list, n_batches):
+    """
+    samples/s of a shuffled DataLoader over at most n_batches batches per num_workers.
+    The time to the first batch (worker start-up) is reported separately.
+    """
+    results = {}
+    for num_workers in num_workers_list:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+
+        start = time.perf_counter()
+        iterator = iter(loader)
+        next(iterator)
+        first_batch = time.perf_counter() - start
+
+        n_samples = 0
+        start = time.perf_counter()
+        for batch_idx, batch in enumerate(iterator):
+            if batch_idx + 1 >= n_batches:
+                break
+            n_samples += len(batch[0])
+        elapsed = time.perf_counter() - start
+        del iterator
+
+        results[str(num_workers)] = {'first_batch_s': first_batch,
+                                     'samples': n_samples,
+                                     'samples_per_s': n_samples / elapsed if elapsed > 0 else None}
+        print("    num_workers={}: {:.1f} samples/s, first batch after {:.2f}s".format(
+            num_workers, results[str(num_workers)]['samples_per_s'] or 0, first_batch))
+    return results
+
+
+def write_synthetic_opus(data_dir, samples_per_class, input_size=400, n_channels=7, seed=0):
+    """Writes .mat files in the OPUS patient folder layout, one square 'nerve' per ROI"""
+    rng = np.random.RandomState(seed)
+    for patient in range(1, 13):
+        for nerve_class in _OPUS_CLASSES:
+            opus_dir = os.path.join(data_dir, 'patient_{:03d}'.format(patient), nerve_class, 'OPUS')
+            roi_dir = os.path.join(data_dir, 'patient_{:03d}'.format(patient), nerve_class, 'ROI')
+            os.makedirs(opus_dir, exist_ok=True)
+            os.makedirs(roi_dir, exist_ok=True)
+            for k in range(samples_per_class):
+                image = rng.rand(input_size, input_size, n_channels)
+                roi = np.zeros((input_size, input_size))
+                top, left = rng.randint(0, input_size - 50, size=2)
+                roi[top:top + 50, left:left + 50] = 255
+                filename = '_{}_{:02d}.mat'.format(patient * 100 + k, k)
+                scipy.io.savemat(os.path.join(opus_dir, 'OPUS_NNMF' + filename), {'opus_nnmf': image})
+                scipy.io.savemat(os.path.join(roi_dir, 'ROI' + filename), {'ROI': roi})
+
+
+def write_synthetic_lidc(data_dir, n_samples, image_size=128, seed=0):
+    """Writes a pickle in the LIDC-IDRI format: images in [0, 1] with four binary annotator masks"""
+    rng = np.random.RandomState(seed)
+    data = {}
+    for i in range(n_samples):
+        data['sample_{}'.format(i)] = {'image': rng.rand(image_size, image_size).astype(np.float32),
+                                       'masks': [(rng.rand(image_size, image_size) > 0.9).astype(np.uint8)
+                                                 for _ in range(4)]}
+    with open(os.path.join(data_dir, 'data.pickle'), 'wb') as f:
+        pickle.dump(data, f)
+
+
+def benchmark_opus(data_dir, args):
+    print("OPUS")
+    dataset = OPUSDataset('train', data_dir, transform=None)
+    indices = list(range(min(args.n_samples, len(dataset))))
+    stages = {}
+
+    stages['load_files'], raw = time_stage(
+        lambda idx: {'image': load_files(dataset.image_list[idx], dtype=dataset.dtype),
+                     'labels': np.expand_dims(label_mask(load_files(dataset.labels_list[idx])), axis=2)},
+        indices)
+    # p=1, so every sample is deformed
+    stages['elastic_deform'], deformed = time_stage(elastic_deform(1.0), raw)
+    stages['Rescale'], rescaled = time_stage(Rescale(args.input_size), deformed)
+    stages['norm'], _ = time_stage(lambda sample: norm(sample['image'].copy()), rescaled)
+    stages['ToTensor'], tensors = time_stage(ToTensor(), [dict(s, image=s['image'].copy()) for s in rescaled])
+    # ToTensor with the normalization fused in, statistics of the timed samples
+    pixels = np.concatenate([s['image'].reshape(-1, s['image'].shape[-1]) for s in rescaled])
+    stages['ToTensor_fused'], _ = time_stage(ToTensor(pixels.mean(axis=0).tolist(), pixels.std(axis=0).tolist()),
+                                             rescaled)
+    n_channels = tensors[0]['image'].shape[0]
+    stages['NumpyNormalize'], _ = time_stage(
+        NumpyNormalize([0.5] * n_channels, [0.25] * n_channels),
+        [{'image': s['image'].numpy(), 'labels': s['labels']} for s in tensors])
+    samples = [(s['image'].float(), torch.from_numpy(np.asarray(s['labels'])).float(), 0) for s in tensors]
+    stages['collate'], _ = time_stage(default_collate, [samples[:args.batch_size]] * len(indices))
+
+    for name, stats in stages.items():
+        print("    {:15s} {:8.2f} ms".format(name, stats['mean_ms']))
+
+    # the training transform of OPUSDataLoader
+    dataset.transform = transforms.Compose([elastic_deform(0.5), Rescale(args.input_size), ToTensor()])
+    throughput = measure_throughput(dataset, args.batch_size, args.num_workers, args.n_batches)
+    return {'n_samples': len(dataset), 'stages': stages, 'throughput': throughput}
+
+
+def benchmark_lidc(data_dir, args):
+    print("LIDC-IDRI")
+    start = time.perf_counter()
+    dataset = LIDC_IDRI(data_dir if data_dir.endswith(os.sep) else data_dir + os.sep)
+    stages = {'open_dataset': {'mean_ms': (time.perf_counter() - start) * 1000, 'std_ms': 0.0, 'n': 1}}
+
+    indices = list(range(min(args.n_samples, len(dataset))))
+    stages['getitem'], samples = time_stage(dataset.__getitem__, indices)
+    stages['collate'], _ = time_stage(default_collate, [samples[:args.batch_size]] * len(indices))
+
+    for name, stats in stages.items():
+        print("    {:15s} {:8.2f} ms".format(name, stats['mean_ms']))
+
+    throughput = measure_throughput(dataset, args.batch_size, args.num_workers, args.n_batches)
+    return {'n_samples': len(dataset), 'stages': stages, 'throughput': throughput}
+
+
+def benchmark_mnist(data_dir, args):
+    print("MNIST")
+    dataset = MnistDataLoader(data_dir, args.batch_size, num_workers=0).dataset
+    transform, dataset.transform = dataset.transform, None
+
+    indices = list(range(min(args.n_samples, len(dataset))))
+    stages = {}
+    stages['getitem_raw'], raw = time_stage(lambda idx: dataset[idx][0], indices)
+    for t in transform.transforms:
+        stages[t.__class__.__name__], raw = time_stage(t, raw)
+    dataset.transform = transform
+    stages['collate'], _ = time_stage(default_collate, [[dataset[i] for i in indices[:args.batch_size]]] * len(indices))
+
+    for name, stats in stages.items():
+        print("    {:15s} {:8.2f} ms".format(name, stats['mean_ms']))
+
+    throughput = measure_throughput(dataset, args.batch_size, args.num_workers, args.n_batches)
+    return {'n_samples': len(dataset), 'stages': stages, 'throughput': throughput}
+
+
+if __name__ == "__main__":
+
+    args = argparse.ArgumentParser(description="Data pipeline benchmark")
+    args.add_argument("--opus_dir", type=str, default=None,
+                      help="OPUS data folder containing the patient_xxx folders")
+    args.add_argument("--lidc_dir", type=str, default=None,
+                      help="LIDC-IDRI folder with the pickle or the converted store")
+    args.add_argument("--mnist_dir", type=str, default=None,
+                      help="MNIST folder (downloaded if missing)")
+    args.add_argument("--synthetic", action="store_true",
+                      help="Benchmark OPUS and LIDC-IDRI on synthetic data instead of --opus_dir/--lidc_dir")
+    args.add_argument("--synthetic_samples", type=int, default=2,
+                      help="Synthetic OPUS samples per patient and nerve class (default: 2)")
+    args.add_argument("--num_workers", type=int, nargs="+", default=[0, 1, 2, 4],
+                      help="num_workers values to measure the throughput for (default: 0 1 2 4)")
+    args.add_argument("--batch_size", type=int, default=4,
+                      help="Batch size (default: 4)")
+    args.add_argument("--n_samples", type=int, default=10,
+                      help="Samples to time every stage on (default: 10)")
+    args.add_argument("--n_batches", type=int, default=20,
+                      help="Maximum number of batches per throughput measurement (default: 20)")
+    args.add_argument("--input_size", type=int, default=400,
+                      help="Rescale size of the OPUS pipeline (default: 400)")
+    args.add_argument("-o", "--output", type=str, default="data_pipeline_benchmark.json",
+                      help="JSON file the results are written to")
+
+    args = args.parse_args()
+
+    synthetic_dir = None
+    if args.synthetic:
+        synthetic_dir = tempfile.mkdtemp(prefix='data_pipeline_benchmark_')
+        args.opus_dir = os.path.join(synthetic_dir, 'opus')
+        args.lidc_dir = os.path.join(synthetic_dir, 'lidc')
+        os.makedirs(args.lidc_dir)
+        print("Writing synthetic data to", synthetic_dir)
+        write_synthetic_opus(args.opus_dir, args.synthetic_samples)
+        write_synthetic_lidc(args.lidc_dir, 12 * len(_OPUS_CLASSES) * args.synthetic_samples)
+
+    results = {}
+    try:
+        if args.opus_dir is not None:
+            results['opus'] = benchmark_opus(args.opus_dir, args)
+        if args.lidc_dir is not None:
+            results['lidc'] = benchmark_lidc(args.lidc_dir, args)
+        if args.mnist_dir is not None:
+            results['mnist'] = benchmark_mnist(args.mnist_dir, args)
+    finally:
+        if synthetic_dir is not None:
+            shutil.rmtree(synthetic_dir)
+
+    write_json({'git_commit': git_commit(),
+                'date': datetime.datetime.now().isoformat(),
+                'synthetic': args.synthetic,
+                'args': vars(args),
+                'results': results},
+               args.output)
+    print("Results written to", args.output)
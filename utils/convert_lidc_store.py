@@ -0,0 +1,32 @@
+import argparse
+import os
+import sys
+
+# This is important to be able to call other modules
+# in the upper directory (root dir for our code)
+sys.path.append(os.getcwd())
+
+from data_loaders import convert_lidc_dataset
+
+"""
+    Converts the LIDC-IDRI pickle into the sharded, memory-mapped store once.
+    Point 'data_dir' of the LidcDataLoader config to the store folder
+    afterwards, LIDC_IDRI detects the format by its index file.
+"""
+
+if __name__ == "__main__":
+
+    args = argparse.ArgumentParser(description="LIDC-IDRI store converter")
+    args.add_argument("-i", "--pickle_path", type=str, required=True,
+                      help="Path to the LIDC-IDRI pickle file")
+    args.add_argument("-o", "--store_dir", type=str, required=True,
+                      help="Folder the store is written to")
+    args.add_argument("--shard_size", type=int, default=1024,
+                      help="Number of samples per shard (default: 1024)")
+    args.add_argument("--no_pack_masks", action="store_true",
+                      help="Store the masks as uint8 instead of bit-packed")
+
+    args = args.parse_args()
+
+    convert_lidc_dataset(args.pickle_path, args.store_dir,
+                         shard_size=args.shard_size, pack_masks=not args.no_pack_masks)
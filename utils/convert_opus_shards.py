@@ -0,0 +1,33 @@
+import argparse
+import os
+import sys
+
+# This is important to be able to call other modules
+# in the upper directory (root dir for our code)
+sys.path.append(os.getcwd())
+
+from data_loaders import convert_opus_shards
+
+"""
+    Packs the OPUS patient folders into sequential tar shards once. Training
+    then streams the shards with the OPUSShardDataLoader data loader type and
+    'data_dir' set to the shard folder in the network config.
+"""
+
+if __name__ == "__main__":
+
+    args = argparse.ArgumentParser(description="OPUS shard converter")
+    args.add_argument("-d", "--data_dir", type=str, required=True,
+                      help="OPUS data folder containing the patient_xxx folders")
+    args.add_argument("-o", "--shard_dir", type=str, required=True,
+                      help="Folder the shards are written to")
+    args.add_argument("-p", "--patients", type=str, nargs="+", default=None,
+                      help="Patients to convert (default: all patient folders)")
+    args.add_argument("-m", "--manifest_path", type=str, default=None,
+                      help="Dataset manifest used to pair the files (default: None)")
+    args.add_argument("-n", "--samples_per_shard", type=int, default=100,
+                      help="Maximum number of samples per shard (default: 100)")
+
+    args = args.parse_args()
+
+    convert_opus_shards(args.data_dir, args.shard_dir, args.patients, args.manifest_path, args.samples_per_shard)
@@ -0,0 +1,31 @@
+import argparse
+import os
+import sys
+
+# This is important to be able to call other modules
+# in the upper directory (root dir for our code)
+sys.path.append(os.getcwd())
+
+from data_loaders import convert_opus_dataset
+
+"""
+    Converts the OPUS patient folders into the memory-mapped sample store
+    once. Training then reads the store by setting 'store_dir' in the
+    data_loader args of the network config.
+"""
+
+if __name__ == "__main__":
+
+    args = argparse.ArgumentParser(description="OPUS sample store converter")
+    args.add_argument("-d", "--data_dir", type=str, required=True,
+                      help="OPUS data folder containing the patient_xxx folders")
+    args.add_argument("-o", "--store_dir", type=str, required=True,
+                      help="Folder the sample store is written to")
+    args.add_argument("-p", "--patients", type=str, nargs="+", default=None,
+                      help="Patients to convert (default: all patient folders)")
+    args.add_argument("-m", "--manifest_path", type=str, default=None,
+                      help="Dataset manifest used to pair the files (default: None)")
+
+    args = args.parse_args()
+
+    convert_opus_dataset(args.data_dir, args.store_dir, args.patients, args.manifest_path)
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+
+# This is important to be able to call other modules
+# in the upper directory (root dir for our code)
+sys.path.append(os.getcwd())
+
+import torch
+
+import model as module_arch
+from utils import read_json
+
+"""
+    Exports a trained checkpoint (e.g. model_best.pth) as a frozen TorchScript
+    artifact for batch inference, which inference.py loads without the training
+    stack. With --mc_samples the dropout layers stay active and every call
+    returns that many MC samples.
+"""
+
+if __name__ == "__main__":
+
+    args = argparse.ArgumentParser(description="Inference model export")
+    args.add_argument("-r", "--resume", type=str, required=True,
+                      help="Checkpoint to export, e.g. model_best.pth")
+    args.add_argument("-c", "--config", type=str, default=None,
+                      help="Config of the run (default: config.json next to the checkpoint)")
+    args.add_argument("-o", "--output", type=str, required=True,
+                      help="File the artifact is written to")
+    args.add_argument("-m", "--mode", type=str, default="trace", choices=["trace", "script"],
+                      help="TorchScript conversion, script needs scriptable modules, which the blocks of "
+                           "nn_common_modules are not (default: trace)")
+    args.add_argument("-n", "--mc_samples", type=int, default=0,
+                      help="MC samples per call, 0 exports the deterministic model (default: 0)")
+    args.add_argument("--input_size", type=int, default=None,
+                      help="Image size of the example input the model is traced with "
+                           "(default: input_size of the data loader, else 400)")
+    args.add_argument("--batch_size", type=int, default=1,
+                      help="Batch size of the example input (default: 1)")
+    args.add_argument("--device", type=str, default="cpu",
+                      help="Device the model is exported on (default: cpu)")
+
+    args = args.parse_args()
+
+    config_path = args.config or os.path.join(os.path.dirname(args.resume), 'config.json')
+    config = read_json(config_path)
+    # read before the model is built, which changes num_channels in the params
+    num_channels = config['arch']['args']['params']['num_channels']
+    input_size = args.input_size or config['data_loader']['args'].get('input_size', 400)
+
+    model = getattr(module_arch, config['arch']['type'])(**config['arch']['args'])
+    print("Loading checkpoint: {} ...".format(args.resume))
+    checkpoint = torch.load(args.resume, map_location=torch.device(args.device))
+    # checkpoints of multi GPU runs hold the weights of the DataParallel wrapper
+    state_dict = {key[len('module.'):] if key.startswith('module.') else key: value
+                  for key, value in checkpoint['state_dict'].items()}
+    model.load_state_dict(state_dict)
+    model = model.to(args.device)
+
+    example_input = torch.zeros(args.batch_size, num_channels, input_size, input_size, device=args.device)
+    module_arch.export_model(model, example_input, args.output, mode=args.mode, mc_samples=args.mc_samples,
+                             metadata={'arch': config['arch']['type'],
+                                       'checkpoint': args.resume,
+                                       'epoch': checkpoint.get('epoch')})
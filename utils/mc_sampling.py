@@ -0,0 +1,140 @@
+import torch
+import torch.nn as nn
+
+# =============================================================================
+# Batched MC-dropout sampling
+# The MC samples are folded into the batch dimension: the batch is repeated
+# once per replica and the model runs on [REPLICAS * BATCH_SIZE x C x H x W].
+# Dropout2d draws its channel mask per batch element, so every replica gets
+# independent masks. The replicas are split into as few forward passes as
+# the configured batch size or memory budget allow, the mean and variance are
+# accumulated per pass. Without either, every pass holds a single replica.
+# Models with a forward_prefix / forward_sampled pair (e.g. QuickNat) run the
+# deterministic prefix up to their first dropout once per batch, only the
+# stochastic rest of the model runs per replica.
+# =============================================================================
+
+
+def _reset_peak_memory(device):
+    """Resets the peak CUDA memory statistics, False if this torch version cannot"""
+    if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+        # torch >= 1.4
+        torch.cuda.reset_peak_memory_stats(device)
+    elif hasattr(torch.cuda, 'reset_max_memory_allocated'):
+        torch.cuda.reset_max_memory_allocated(device)
+    else:
+        return False
+    return True
+
+
+def _batch_norm_in_training(model):
+    # batch statistics over folded replicas differ from those of the single batch
+    return any(m.training for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm))
+
+
+class MCSampler(object):
+    """
+    Draws MC-dropout samples of a model.
+
+    max_batch_size: maximum number of images (replicas x batch size) per forward pass
+    memory_budget_mb: CUDA memory per forward pass. The memory of one replica is measured
+                      on the first pass for every input shape, the other passes are sized
+                      from it. Ignored if max_batch_size is set.
+    Without both, every forward pass holds one replica, as without folding, so existing
+    configs keep their memory use. Models with batch norm layers in training mode get one
+    replica per pass, as their batch statistics would change otherwise.
+    """
+
+    def __init__(self, max_batch_size=None, memory_budget_mb=None):
+        self.max_batch_size = max_batch_size
+        self.memory_budget_mb = memory_budget_mb
+        # replicas per forward pass by input shape, for the memory budget
+        self._replicas_per_pass = {}
+
+    def _replicas(self, model, data, num_samples):
+        """Replicas of the next forward pass, None if they are still to be measured"""
+        batch_size = data.shape[0]
+        if _batch_norm_in_training(model):
+            return 1
+        if self.max_batch_size is not None:
+            return max(1, self.max_batch_size // batch_size)
+        if self.memory_budget_mb is not None and data.is_cuda:
+            return self._replicas_per_pass.get(tuple(data.shape))
+        return 1
+
+    def _measured_forward(self, forward, data):
+        """A forward pass of one replica that records how many replicas fit into the memory budget"""
+        device = data.device
+        torch.cuda.synchronize(device)
+        if not _reset_peak_memory(device):
+            print("MCSampler: torch {} cannot measure the peak memory, mc_memory_budget_mb "
+                  "falls back to one replica per pass".format(torch.__version__))
+            self._replicas_per_pass[tuple(data.shape)] = 1
+            return forward(data)
+        allocated = torch.cuda.memory_allocated(device)
+
+        out = forward(data)
+
+        torch.cuda.synchronize(device)
+        per_replica = max(torch.cuda.max_memory_allocated(device) - allocated, 1)
+        self._replicas_per_pass[tuple(data.shape)] = max(1, int(self.memory_budget_mb * 1024 ** 2 // per_replica))
+        return out
+
+    def __call__(self, model, data, num_samples, keep_samples=True, output_fn=None):
+        """
+        model: the model to sample, with its dropout layers active
+        data: [BATCH_SIZE x C x H x W]
+        num_samples: number of MC samples
+        keep_samples: keep every sample, otherwise only the running mean and variance
+        output_fn: applied to the model output of every pass, e.g. an argmax
+        returns: mean, (unbiased) variance over the samples, both [BATCH_SIZE x ...], and the
+                 samples [BATCH_SIZE x NUM_SAMPLES x ...] or None without keep_samples
+        """
+        batch_size = data.shape[0]
+        mean, m2, samples = None, None, None
+
+        forward = model
+        # with batch norm in training mode, every replica updates the running statistics
+        if hasattr(model, 'forward_prefix') and not _batch_norm_in_training(model):
+            data, forward = model.forward_prefix(data), model.forward_sampled
+        n_done = 0
+
+        while n_done < num_samples:
+            replicas = self._replicas(model, data, num_samples)
+            if replicas is None:
+                out = self._measured_forward(forward, data)
+                replicas = 1
+            else:
+                replicas = min(replicas, num_samples - n_done)
+                folded = data.repeat(replicas, *([1] * (data.dim() - 1)))
+                out = forward(folded)
+            if output_fn is not None:
+                out = output_fn(out)
+            # [REPLICAS x BATCH_SIZE x ...]
+            out = out.view(replicas, batch_size, *out.shape[1:])
+
+            if keep_samples:
+                if samples is None:
+                    samples = out.new_zeros((batch_size, num_samples) + tuple(out.shape[2:]))
+                samples[:, n_done:n_done + replicas] = out.transpose(0, 1)
+
+            # merge the mean and the sum of squared deviations of this pass (Chan et al.)
+            chunk_mean = out.mean(dim=0)
+            chunk_m2 = ((out - chunk_mean) ** 2).sum(dim=0)
+            if mean is None:
+                mean, m2 = chunk_mean, chunk_m2
+            else:
+                n_total = n_done + replicas
+                delta = chunk_mean - mean
+                mean = mean + delta * (replicas / n_total)
+                m2 = m2 + chunk_m2 + delta ** 2 * (n_done * replicas / n_total)
+            n_done += replicas
+
+        variance = m2 / (num_samples - 1) if num_samples > 1 else torch.zeros_like(m2)
+        return mean, variance, samples
+
+    @classmethod
+    def from_config(cls, cfg_trainer):
+        """Sampler for the 'mc_max_batch_size' and 'mc_memory_budget_mb' options of the trainer config"""
+        return cls(max_batch_size=cfg_trainer.get('mc_max_batch_size'),
+                   memory_budget_mb=cfg_trainer.get('mc_memory_budget_mb'))
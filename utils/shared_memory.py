@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+
+class SharedArrayTable(object):
+    """
+    Packs a list of numpy arrays into one flat tensor in shared memory.
+
+    DataLoader workers inherit (or attach to) the same segment instead of
+    holding per-sample Python objects, whose refcount updates would turn the
+    forked copy-on-write pages into real copies in every worker.
+
+    arrays: list of numpy arrays with the same number of dimensions
+    dtype: dtype of the table, dtype of the first array by default
+    """
+
+    def __init__(self, arrays, dtype=None):
+        if dtype is None:
+            dtype = np.asarray(arrays[0]).dtype if len(arrays) > 0 else np.float32
+        dtype = np.dtype(dtype)
+        ndim = np.ndim(arrays[0]) if len(arrays) > 0 else 1
+
+        self.shapes = np.zeros((len(arrays), ndim), dtype=np.int64)
+        self.offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        for i, a in enumerate(arrays):
+            self.shapes[i] = np.shape(a)
+            self.offsets[i + 1] = self.offsets[i] + np.size(a)
+
+        # torch picks the matching tensor type for the numpy dtype
+        torch_dtype = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+        self.data = torch.empty(int(self.offsets[-1]), dtype=torch_dtype).share_memory_()
+
+        flat = self.data.numpy()
+        for i, a in enumerate(arrays):
+            flat[self.offsets[i]:self.offsets[i + 1]] = np.asarray(a, dtype=dtype).ravel()
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.data.numpy()[start:end].reshape(self.shapes[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class SharedStringTable(SharedArrayTable):
+    """
+    A list of strings (e.g. file paths) kept as utf-8 bytes in shared memory.
+    """
+
+    def __init__(self, strings):
+        super().__init__([np.frombuffer(s.encode('utf-8'), dtype=np.uint8) for s in strings], dtype=np.uint8)
+
+    def __getitem__(self, idx):
+        return super().__getitem__(idx).tobytes().decode('utf-8')
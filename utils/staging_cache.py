@@ -0,0 +1,159 @@
+import os
+import shutil
+import threading
+
+# =============================================================================
+# Local staging cache
+# Files below a (remote) source root are copied to a local cache directory on
+# first access and read from there afterwards. A copy is fresh while its size
+# and mtime match the source file. The cache is organized in groups, the first
+# path component below the source root (e.g. patient_xxx), and the least
+# recently used groups are evicted when the cache grows over its budget.
+# All state lives in the cache directory, so DataLoader workers, several runs
+# and repeated cross validation folds on the same node share the cache.
+# =============================================================================
+
+_LAST_USED_DIR = '.last_used'
+
+
+def _file_size(path):
+    # files can be replaced or evicted by other processes meanwhile
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+class StagingCache(object):
+    """
+    source_root: root folder of the remote data, only files below it are staged
+    cache_dir: local folder the files are copied to
+    budget_gb: maximum size of the cache in GB, unlimited if None
+    """
+
+    def __init__(self, source_root, cache_dir, budget_gb=None):
+        self.source_root = os.path.abspath(source_root)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.budget_bytes = None if budget_gb is None else int(budget_gb * 1024 ** 3)
+        os.makedirs(os.path.join(self.cache_dir, _LAST_USED_DIR), exist_ok=True)
+
+        # estimate of the cache size, recounted before evicting
+        self._size = None
+        # e.g. read-ahead threads staging files concurrently
+        self._evict_lock = threading.Lock()
+        if self.budget_bytes is not None:
+            # e.g. after the budget was lowered
+            self._add_size(0, None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_evict_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._evict_lock = threading.Lock()
+
+    def _relative_path(self, path):
+        relative_path = os.path.relpath(os.path.abspath(path), self.source_root)
+        if relative_path.startswith(os.pardir) or os.path.isabs(relative_path):
+            return None
+        return relative_path
+
+    @staticmethod
+    def _group(relative_path):
+        return relative_path.split(os.sep)[0]
+
+    def _touch(self, group):
+        marker = os.path.join(self.cache_dir, _LAST_USED_DIR, group)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+
+    def stage(self, path):
+        """
+        Returns the path of the local copy of the file, copying it first if it is
+        missing or stale. Files outside of the source root are returned unchanged.
+        """
+        relative_path = self._relative_path(path)
+        if relative_path is None:
+            return path
+
+        local_path = os.path.join(self.cache_dir, relative_path)
+        source_stat = os.stat(path)
+        try:
+            local_stat = os.stat(local_path)
+            fresh = local_stat.st_size == source_stat.st_size and local_stat.st_mtime == source_stat.st_mtime
+        except FileNotFoundError:
+            fresh = False
+
+        group = self._group(relative_path)
+        # the group counts as used before it is (re-)filled, so it is the last one to be evicted
+        self._touch(group)
+
+        if not fresh:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # copy and rename, so concurrent readers never see a partial file
+            tmp_path = local_path + '.tmp{}_{}'.format(os.getpid(), threading.get_ident())
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, local_path)
+            self._add_size(source_stat.st_size, group)
+
+        return local_path
+
+    def _group_sizes(self):
+        sizes = {}
+        for entry in os.scandir(self.cache_dir):
+            if entry.name == _LAST_USED_DIR:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                sizes[entry.name] = sum(_file_size(os.path.join(root, f))
+                                        for root, _, files in os.walk(entry.path) for f in files)
+            else:
+                sizes[entry.name] = _file_size(entry.path)
+        return sizes
+
+    def _last_used(self, group):
+        try:
+            return os.stat(os.path.join(self.cache_dir, _LAST_USED_DIR, group)).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def _add_size(self, n_bytes, current_group):
+        if self.budget_bytes is None:
+            return
+        if self._size is None:
+            self._size = sum(self._group_sizes().values())
+        else:
+            self._size += n_bytes
+        # another thread of this process is evicting already
+        if self._size > self.budget_bytes and self._evict_lock.acquire(blocking=False):
+            try:
+                self.evict(keep=current_group)
+            finally:
+                self._evict_lock.release()
+
+    def evict(self, keep=None):
+        """Removes the least recently used groups until the cache fits into the budget, except the group keep"""
+        sizes = self._group_sizes()
+        size = sum(sizes.values())
+        for group in sorted(sizes, key=self._last_used):
+            if size <= self.budget_bytes:
+                break
+            if group == keep:
+                continue
+            print("Staging cache: evicting {} ({:.1f} MB)".format(group, sizes[group] / 1024 ** 2))
+            group_path = os.path.join(self.cache_dir, group)
+            if os.path.isdir(group_path):
+                shutil.rmtree(group_path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(group_path)
+                except FileNotFoundError:
+                    pass
+            try:
+                os.remove(os.path.join(self.cache_dir, _LAST_USED_DIR, group))
+            except FileNotFoundError:
+                pass
+            size -= sizes[group]
+        self._size = size
@@ -1,6 +1,8 @@
 from __future__ import division
 
 import collections
+import functools
+import io
 import json
 import os
 import pickle
@@ -24,6 +26,7 @@ from scipy.ndimage.interpolation import map_coordinates
 from torch.autograd import Variable
 
 from utils import visualization
+from utils.mc_sampling import MCSampler
 
 np.seterr(divide='ignore', invalid='ignore')
 
@@ -87,18 +90,21 @@ class MetricTracker:
 
 def load_pickle_file(dataset_location):
     max_bytes = 2 ** 31 - 1
-    data = {}
-    new_data = None
     print("Loading file", dataset_location)
-    bytes_in = bytearray(0)
     input_size = os.path.getsize(dataset_location)
+    # read in chunks of max_bytes into one preallocated buffer instead of growing a bytearray
+    bytes_in = bytearray(input_size)
+    view = memoryview(bytes_in)
     with open(dataset_location, 'rb') as f_in:
-        for _ in range(0, input_size, max_bytes):
-            bytes_in += f_in.read(max_bytes)
-    new_data = pickle.loads(bytes_in)
-    data.update(new_data)
-
-    del new_data
+        start = 0
+        while start < input_size:
+            n_read = f_in.readinto(view[start:start + max_bytes])
+            if not n_read:
+                break
+            start += n_read
+    data = pickle.loads(bytes_in)
+
+    del view, bytes_in
     return data
 
 
@@ -168,82 +174,104 @@ def save_mask_prediction_example(mask, pred, iter):
     plt.savefig('images/'+str(iter)+"_mask.png")
 
 
-def norm(ar):
+def norm(ar, dtype=None):
+    """ Min-max normalization along the first axis, in place unless ar has to be converted to dtype """
+    if dtype is not None:
+        ar = ar.astype(dtype, copy=False)
     ar -= np.min(ar, axis=0)
     ar /= np.ptp(ar, axis=0)
     return ar
 
 
 # deform function
-def elastic_deformation(image, x_coord, y_coord, dx, dy):
-    """ Applies random elastic deformation to the input image 
-        with given coordinates and displacement values of deformation points.
-        Keeps the edge of the image steady by adding a few frame points that get displacement value zero.
-    Input: image: array of shape (N.M,C) (Haven't tried it out for N != M), C number of channels
-           x_coord: array of shape (L,) contains the x coordinates for the deformation points
-           y_coord: array of shape (L,) contains the y coordinates for the deformation points
-           dx: array of shape (L,) contains the displacement values in x direction
-           dy: array of shape (L,) contains the displacement values in x direction
-    Output: the deformed image (shape (N,M,C))
+@functools.lru_cache(maxsize=8)
+def _elastic_grid(shape):
+    """ Shape dependent, read-only parts of the elastic deformation, computed once per image shape.
+    Output: anker point coordinates (x, y), coordinates of the fine grid in the order
+            elastic_deformation has always evaluated them, base row and column index grids
     """
-
-    # Preliminaries
-    # dimensions of the input image
-    shape = image.shape
-
     # centers of x and y axis
     x_center = shape[1]/2
     y_center = shape[0]/2
 
-    # Construction of the coarse grid
-    # deformation points: coordinates
-
-    # anker points: coordinates
+    # anker points: coordinates, they keep the edge of the image steady
     x_coord_anker_points = np.array(
         [0, x_center, shape[1] - 1, 0, shape[1] - 1, 0, x_center, shape[1] - 1])
     y_coord_anker_points = np.array(
         [0, 0, 0, y_center, y_center, shape[0] - 1, shape[0] - 1, shape[0] - 1])
-    # anker points: values
-    dx_anker_points = np.zeros(8)
-    dy_anker_points = np.zeros(8)
+
+    # coordinates of fine grid: x major, y minor
+    x_fine, y_fine = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]), indexing='ij')
+    coord_fine = np.stack([x_fine.ravel(), y_fine.ravel()], axis=-1).astype(np.float64)
+
+    rows, cols = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+
+    for a in (x_coord_anker_points, y_coord_anker_points, coord_fine, rows, cols):
+        a.setflags(write=False)
+    return x_coord_anker_points, y_coord_anker_points, coord_fine, rows, cols
+
+
+def elastic_displacement(shape, x_coord, y_coord, dx, dy):
+    """ Dense displacement field of an elastic deformation (see elastic_deformation).
+    The cubic interpolation is linear in the interpolated values and the anker points
+    have displacement zero, so a single interpolation of the basis functions of the
+    deformation points gives both the x and the y displacement.
+    Input: shape: shape of the image, (N,M) or (N,M,C)
+           x_coord, y_coord, dx, dy: as in elastic_deformation
+    Output: row and column displacement, arrays of shape (N,M)
+    """
+    shape = tuple(shape[:2])
+    x_coord_anker_points, y_coord_anker_points, coord_fine, _, _ = _elastic_grid(shape)
+
+    x_coord, y_coord = np.atleast_1d(x_coord), np.atleast_1d(y_coord)
+    dx, dy = np.atleast_1d(dx).astype(np.float64), np.atleast_1d(dy).astype(np.float64)
+    n_points = len(x_coord)
 
     # combine deformation and anker points to coarse grid
-    x_coord_coarse = np.append(x_coord, x_coord_anker_points)
-    y_coord_coarse = np.append(y_coord, y_coord_anker_points)
-    coord_coarse = np.array(list(zip(x_coord_coarse, y_coord_coarse)))
-
-    dx_coarse = np.append(dx, dx_anker_points)
-    dy_coarse = np.append(dy, dy_anker_points)
-
-    # Interpolation onto fine grid
-    # coordinates of fine grid
-    coord_fine = [[x, y] for x in range(shape[1]) for y in range(shape[0])]
-    # interpolate displacement in both x and y direction
-    # cubic works better but takes longer
-    dx_fine = ipol.griddata(coord_coarse, dx_coarse,
-                            coord_fine, method='cubic')
-    # other options: 'linear'
-    dy_fine = ipol.griddata(coord_coarse, dy_coarse,
-                            coord_fine, method='cubic')
-    # get the displacements into shape of the input image (the same values in each channel)
-
-    dx_fine = dx_fine.reshape(shape[0:2])
-    dx_fine = np.stack([dx_fine]*shape[2], axis=-1)
-    dy_fine = dy_fine.reshape(shape[0:2])
-    dy_fine = np.stack([dy_fine]*shape[2], axis=-1)
-
-    # Deforming the image: apply the displacement grid
-    # base grid
-    x, y, z = np.meshgrid(np.arange(shape[0]), np.arange(
-        shape[1]), np.arange(shape[2]))
+    coord_coarse = np.stack([np.append(x_coord, x_coord_anker_points),
+                             np.append(y_coord, y_coord_anker_points)], axis=-1)
+    # basis values: one for each deformation point at its own coordinates, zero elsewhere
+    basis_coarse = np.eye(n_points + 8, n_points)
+
+    # cubic works better than 'linear' but takes longer
+    basis_fine = ipol.CloughTocher2DInterpolator(coord_coarse, basis_coarse)(coord_fine)
+
+    # get the displacements into shape of the input image
+    dx_fine = basis_fine.dot(dx).reshape(shape)
+    dy_fine = basis_fine.dot(dy).reshape(shape)
+    return dy_fine, dx_fine
+
+
+def apply_displacement(image, displacement, order=2):
+    """ Evaluates every channel of the image at the displaced coordinates.
+    Input: image: array of shape (N,M) or (N,M,C)
+           displacement: row and column displacement from elastic_displacement
+           order: spline order, 0 samples the nearest neighbour (e.g. for label masks)
+    Output: the deformed image, same shape and dtype as the input
+    """
+    _, _, _, rows, cols = _elastic_grid(tuple(image.shape[:2]))
     # add displacement to base grid (-> new coordinates)
-    indices = np.reshape(y+dy_fine, (-1, 1)), np.reshape(x +
-                                                         dx_fine, (-1, 1)), np.reshape(z, (-1, 1))
-    # evaluate the image at the new coordinates
-    deformed_image = map_coordinates(image, indices, order=2, mode='nearest')
-    deformed_image = deformed_image.reshape(image.shape)
+    indices = np.stack([rows + displacement[0], cols + displacement[1]])
 
-    return deformed_image
+    if image.ndim == 2:
+        return map_coordinates(image, indices, order=order, mode='nearest')
+    # the same coordinates in each channel
+    return np.stack([map_coordinates(image[..., c], indices, order=order, mode='nearest')
+                     for c in range(image.shape[2])], axis=-1)
+
+
+def elastic_deformation(image, x_coord, y_coord, dx, dy):
+    """ Applies random elastic deformation to the input image 
+        with given coordinates and displacement values of deformation points.
+        Keeps the edge of the image steady by adding a few frame points that get displacement value zero.
+    Input: image: array of shape (N.M,C) (Haven't tried it out for N != M), C number of channels
+           x_coord: array of shape (L,) contains the x coordinates for the deformation points
+           y_coord: array of shape (L,) contains the y coordinates for the deformation points
+           dx: array of shape (L,) contains the displacement values in x direction
+           dy: array of shape (L,) contains the displacement values in x direction
+    Output: the deformed image (shape (N,M,C))
+    """
+    return apply_displacement(image, elastic_displacement(image.shape, x_coord, y_coord, dx, dy))
 
 
 def binary(o):
@@ -345,30 +373,46 @@ def draw_confusion_matrix(matrix):
     return torch_buf
 
 
-def load_files(filename):
+def load_files(filename, dtype=None, data=None, staging=None):
+    """ Loads a .mat or .png file, converted to dtype (e.g. np.float32) if given.
+        data: contents of the file if they were already read (e.g. by data_loaders.read_ahead)
+        staging: utils.StagingCache the file is read through
+    """
+    array = None
+    if data is not None:
+        source = io.BytesIO(data)
+    elif staging is not None:
+        source = staging.stage(filename)
+    else:
+        source = filename
 
     if filename.endswith('.mat'):
-        file = scipy.io.loadmat(filename)
+        file = scipy.io.loadmat(source)
         keys = file.keys()
         if 'opus' in keys:
-            return np.array(file['opus'])
-        if 'opus_nnmf' in keys:
-            return np.array(file['opus_nnmf'])
-        if 'Recons' in keys:
-            return np.array(file['Recons'])
-        if 'rec_img_nnReg' in keys:
-            return np.array(file['rec_img_nnReg'])
-        if 'us_enhanced' in keys:
-            return np.array(file['us_enhanced'])
-        if 'ROI' in keys:
-            return np.array(file['ROI'])
-        if 'US' in keys:
-            return np.array(file['US'])
+            array = file['opus']
+        elif 'opus_nnmf' in keys:
+            array = file['opus_nnmf']
+        elif 'Recons' in keys:
+            array = file['Recons']
+        elif 'rec_img_nnReg' in keys:
+            array = file['rec_img_nnReg']
+        elif 'us_enhanced' in keys:
+            array = file['us_enhanced']
+        elif 'ROI' in keys:
+            array = file['ROI']
+        elif 'US' in keys:
+            array = file['US']
         else:
             print('unknown format')
 
     if filename.endswith('.png'):
-        return misc.imread(filename)
+        array = misc.imread(source)
+
+    if array is None:
+        return None
+    # a single conversion right after loading, the arrays from loadmat are not shared
+    return np.asarray(array, dtype=dtype) if dtype is not None else np.array(array)
 
 
 def build_segmentation_grid(metrics_sample_count, targets, inputs, samples, avg_output):
@@ -437,7 +481,30 @@ def argmax_over_dim(samples, dim=2, keepdim=True):
     return idx.float()
 
 
-def sample_and_compute_mean(model, data, num_samples, num_channels_model, device):
+def per_sample_loss(criterion, output, *targets):
+    """
+        Evaluates a batch-reduced criterion on every sample of the batch
+        separately, e.g. for importance sampling.
+
+        criterion: the loss function, called as criterion(output, *targets)
+        output: [BATCH_SIZE x ...] or a tuple of those (e.g. segmentation and classification)
+        targets: [BATCH_SIZE x ...] tensors, other arguments (e.g. the epoch) are passed on as they are
+        returns: [BATCH_SIZE] detached losses on the cpu
+    """
+    def select(x, i):
+        if isinstance(x, tuple):
+            return tuple(select(o, i) for o in x)
+        if torch.is_tensor(x) and x.dim() > 0:
+            return x[i:i + 1]
+        return x
+
+    batch_size = output[0].shape[0] if isinstance(output, tuple) else output.shape[0]
+    with torch.no_grad():
+        losses = [criterion(select(output, i), *[select(t, i) for t in targets]) for i in range(batch_size)]
+    return torch.stack([loss.detach().float().cpu() for loss in losses])
+
+
+def sample_and_compute_mean(model, data, num_samples, num_channels_model, device, sampler=None, keep_samples=True):
     """
         Samples the model 'num_samples' times
         then computes the average of these samples
@@ -450,12 +517,11 @@ def sample_and_compute_mean(model, data, num_samples, num_channels_model, device
         num_samples: Number of MC samples
         num_channels_model: the number of the channels in the model output
         device: device to use (cuda or cpu)
+        sampler: utils.MCSampler that folds the samples into the batch, one sample per pass if None
+        keep_samples: return the samples, None otherwise
     """
+    if sampler is None:
+        sampler = MCSampler()
+    mean, _, samples = sampler(model, data, num_samples, keep_samples=keep_samples)
 
-    batch_size, num_channels, image_size = data.shape[0], num_channels_model, tuple(data.shape[2:])
-    samples = torch.zeros(
-        (batch_size, num_samples, num_channels, *image_size)).to(device)
-    for i in range(num_samples):
-        samples[:, i, ...] = model(data)
-
-    return samples.mean(dim=1), samples
+    return mean, samples